@@ -1,42 +1,405 @@
-from fastapi import FastAPI, Request, WebSocket
-from fastapi.responses import HTMLResponse, StreamingResponse, PlainTextResponse
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import gzip
 import json
+from collections import deque
+import threading
+import time
+
+import uvicorn
+
+from html_server.tiles import TileIndex
+from src import metrics
+from src.metrics import log
 
 app = FastAPI()
 
-SVG_DATA = {}
+# current map of every id, {id: MapRecord}, a publish replaces the record
+MAPS = {}
+pending_lods = {}
+# {Client} of every open websocket
 clients = set()
+# messages a client may fall behind by before its queue is collapsed
+CLIENT_QUEUE_SIZE = 32
+# a client that takes longer than this to take one message is dropped
+SEND_TIMEOUT = 10
+# overlays come one spawn at a time, the ones within this many seconds go
+# out to the viewers as one delta
+OVERLAY_BROADCAST_DELAY = 0.05
+# {id: (version the deltas apply on top of, [fragment, ...])} not sent yet
+pending_deltas = {}
+
+# etags of a previous run of the server must not match
+BOOT_ID = f"{time.time_ns():x}"
+TILE_INDEXES = {}
+tile_index_lock = threading.Lock()
+
+# event loop of the server when it runs in a thread of the renderer
+server_loop = None
+
+
+class EncodedSvg:
+    """
+    An svg kept as the utf-8 bytes it was posted as plus the overlay
+    fragments appended to it since. The document is only joined and gzipped
+    once a request needs it, and then at most once.
+    """
+
+    def __init__(self, base: bytes, fragments=None, count=0):
+        self.base = base
+        # shared with the versions appended after this one, only the first
+        # `count` belong to this one
+        self.fragments = fragments if fragments is not None else []
+        self.count = count
+        self.joined = base if count == 0 else None
+        self.gzip_data = None
+        self.lock = threading.RLock()
+
+    @property
+    def data(self):
+        with self.lock:
+            if self.joined is None:
+                with metrics.span("svg_join"):
+                    parts = self.fragments[:self.count]
+                    end = self.base.rfind(b"</svg>")
+                    if end == -1:
+                        self.joined = b"".join([self.base, *parts])
+                    else:
+                        self.joined = b"".join([self.base[:end], *parts, self.base[end:]])
+            return self.joined
+
+    def gzipped(self):
+        with self.lock:
+            if self.gzip_data is None:
+                data = self.data
+                with metrics.span("gzip"):
+                    self.gzip_data = gzip.compress(data, compresslevel=6)
+            return self.gzip_data
+
+    def appended(self, fragment: bytes):
+        # only the list is added to, nothing is copied on the loop
+        fragments = self.fragments
+        if len(fragments) != self.count:
+            # an older version, the newer ones keep their list
+            fragments = fragments[:self.count]
+        fragments.append(fragment)
+        return EncodedSvg(self.base, fragments, self.count + 1)
+
+
+class MapRecord:
+    """
+    One version of a map: the version number, the EncodedSvg and its
+    (screen width, EncodedSvg) tiers for zoomed out viewers. Never changed
+    after it is published, a request reads the record once and gets a body
+    that matches its version.
+    """
+
+    def __init__(self, version, svg, lods):
+        self.version = version
+        self.svg = svg
+        self.lods = lods
+
+
+def current_version(id):
+    record = MAPS.get(id)
+    return record.version if record is not None else 0
+
+
+def get_tile_index(id):
+    """
+    Spatial index of the current svg of `id`, built on the first tile request
+    of every version. Versions that only appended overlays extend the index
+    of an earlier one instead.
+    """
+    record = MAPS.get(id)
+    if record is None or not record.svg.base:
+        return None, None
+
+    svg = record.svg
+    with tile_index_lock:
+        # (version, base, fragments, fragment count, index)
+        cached = TILE_INDEXES.get(id)
+        if cached is not None and cached[0] == record.version:
+            return record.version, cached[4]
+
+        index = None
+        with metrics.span("tile_index"):
+            if cached is not None and cached[1] is svg.base and cached[2] is svg.fragments and cached[3] <= svg.count:
+                index = cached[4].with_overlay(svg.fragments[cached[3]:svg.count])
+                if index is not None:
+                    metrics.count("tile_indexes_extended")
+            if index is None:
+                index = TileIndex(svg.data)
+
+        TILE_INDEXES[id] = (record.version, svg.base, svg.fragments, svg.count, index)
+        return record.version, index
+
+
+class Client:
+    """
+    One viewer socket with its own send queue, drained by a background task
+    so a slow viewer never holds up a POST or the other viewers.
+    """
+
+    def __init__(self, ws: WebSocket):
+        self.ws = ws
+        # (id, version, payload)
+        self.pending = deque()
+        self.ready = asyncio.Event()
+        self.task = asyncio.create_task(self.send_loop())
+
+    def push(self, id, version, payload, full):
+        # a full version makes the viewer fetch the whole map, whatever is
+        # still queued for that id is outdated
+        if full:
+            self.pending = deque(entry for entry in self.pending if entry[0] != id)
+        self.pending.append((id, version, payload))
+
+        # too far behind, the viewer only needs to know the latest version
+        # of every map and fetches them again
+        if len(self.pending) > CLIENT_QUEUE_SIZE:
+            latest = {}
+            for entry_id, entry_version, _ in self.pending:
+                latest[entry_id] = entry_version
+            self.pending = deque(
+                (entry_id, entry_version, json.dumps({"id": entry_id, "version": entry_version}))
+                for entry_id, entry_version in latest.items()
+            )
+
+        self.ready.set()
+
+    async def send_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+
+                while self.pending:
+                    _, _, payload = self.pending.popleft()
+                    await asyncio.wait_for(self.ws.send_text(payload), SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("dropping viewer: %r", e)
+            metrics.count("viewers_dropped")
+            await self.close()
+
+    async def close(self):
+        clients.discard(self)
+        try:
+            await self.ws.close()
+        except Exception:
+            pass
+
+
+def broadcast(message):
+    """
+    Queues `message` for every viewer and returns right away.
+    """
+    payload = json.dumps(message)
+    full = "delta" not in message
+    metrics.count("viewer_messages", len(clients))
+
+    # copied, dead clients leave the set while this runs
+    for client in list(clients):
+        client.push(message["id"], message["version"], payload, full)
+
+
+def svg_response(request, id, version, svg, lod, headers):
+    etag = f'"{BOOT_ID}-{id}-{version}-{"full" if lod is None else lod}"'
+    headers = {
+        **headers,
+        "ETag": etag,
+        "X-Version": str(version),
+        # always revalidate, an unchanged map then only costs a 304
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        metrics.count("not_modified")
+        return Response(status_code=304, headers=headers)
+
+    media_type = "text/plain; charset=utf-8"
+    if svg is None:
+        return Response(b"", media_type=media_type, headers=headers)
+
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(svg.gzipped(), media_type=media_type, headers=headers)
+    return Response(svg.data, media_type=media_type, headers=headers)
 
 
 @app.get("/")
 async def index():
     return HTMLResponse(open("index.html").read())
 
+@app.get("/metrics")
+def metrics_text():
+    # with --in-process this also has every render stage, otherwise only
+    # what the server itself does
+    return PlainTextResponse(metrics.prometheus_text())
+
 @app.get("/current_svg/{id}")
-async def current_svg(id: str):
-    return PlainTextResponse(SVG_DATA.get(id, ""))
+def current_svg(id: str, request: Request, lod: int = None):
+    # read once, a publish on the loop swaps the whole record
+    record = MAPS.get(id)
+    if record is None:
+        return svg_response(request, id, 0, None, None, {"X-Lod-Widths": ""})
+
+    headers = {"X-Lod-Widths": ",".join(str(width) for width, _ in record.lods)}
+    if lod is not None and 0 <= lod < len(record.lods):
+        return svg_response(request, id, record.version, record.lods[lod][1], lod, headers)
+    return svg_response(request, id, record.version, record.svg, None, headers)
 
 @app.post("/svg/{id}")
-async def update_svg(id: str, request: Request):
-    svg = (await request.body()).decode("utf-8")
-    SVG_DATA[id] = svg
+async def update_svg(id: str, request: Request, lod: int = None, width: int = None):
+    svg = EncodedSvg(await request.body())
+
+    # tiers come before their full svg and only go live together with it
+    if lod is not None:
+        pending_lods.setdefault(id, {})[lod] = (width, svg)
+        return {"ok": True}
 
-    # Wrap SVG in JSON safely
-    payload = json.dumps({"id": id, "svg": svg})
+    # encoded once here instead of on every request, off the loop
+    await run_in_threadpool(svg.gzipped)
 
-    for ws in clients:
-        await ws.send_text(payload)
+    tiers = pending_lods.pop(id, {})
+    publish_svg(id, svg, [tiers[lod] for lod in sorted(tiers)])
 
     return {"ok": True}
 
+@app.post("/svg/{id}/overlay")
+async def overlay_svg(id: str, request: Request):
+    return {"ok": publish_overlay(id, await request.body())}
+
+
+# ---- publishing ----
+# shared by the http routes and by renderers in the same process, both only
+# ever call these on the server loop
+
+def publish_svg(id, svg, lods=()):
+    """
+    Makes the EncodedSvg `svg` the current map of `id`, `lods` are its
+    (screen width, EncodedSvg) tiers.
+    """
+    record = MapRecord(current_version(id) + 1, svg, list(lods))
+    MAPS[id] = record
+    # viewers fetch the whole map, deltas on top of an older one are moot
+    pending_deltas.pop(id, None)
+    metrics.count("svgs_received")
+    metrics.count("svg_bytes_received", len(svg.base))
+
+    # viewers fetch the new version themselves, only tell them about it
+    broadcast({"id": id, "version": record.version})
+
+
+def publish_overlay(id, fragment: bytes):
+    """
+    Appends `fragment` to the current map of `id`, False if there is none yet.
+    """
+    previous = MAPS.get(id)
+    if previous is None:
+        return False
+
+    # joined and gzipped lazily by the request that needs it, overlays come
+    # in bursts
+    metrics.count("overlays_received")
+    metrics.count("svg_bytes_received", len(fragment))
+    record = MapRecord(
+        previous.version + 1,
+        previous.svg.appended(fragment),
+        [(width, svg.appended(fragment)) for width, svg in previous.lods],
+    )
+    MAPS[id] = record
+
+    if id not in pending_deltas:
+        pending_deltas[id] = (previous.version, [])
+        asyncio.get_running_loop().call_later(OVERLAY_BROADCAST_DELAY, flush_deltas, id)
+    pending_deltas[id][1].append(fragment.decode("utf-8"))
+    return True
+
+
+def flush_deltas(id):
+    """
+    Sends the overlays of `id` since the last flush as one message, viewers
+    on `base` append it instead of downloading the map again.
+    """
+    pending = pending_deltas.pop(id, None)
+    record = MAPS.get(id)
+    if pending is None or record is None:
+        return
+
+    base, fragments = pending
+    metrics.count("overlays_coalesced", len(fragments) - 1)
+    broadcast({"id": id, "version": record.version, "base": base, "delta": "".join(fragments)})
+
+
+def call_in_server(function, *args):
+    """
+    Runs `function(*args)` on the loop of the in-process server, from any thread.
+    """
+    if server_loop is None:
+        raise RuntimeError("the server is not running in this process")
+    server_loop.call_soon_threadsafe(function, *args)
+
+
+def serve_in_thread(ip="127.0.0.1", port=8000):
+    """
+    Runs uvicorn on its own event loop in a daemon thread of this process,
+    renders are then handed over with call_in_server instead of http.
+    """
+    global server_loop
+
+    server = uvicorn.Server(uvicorn.Config(app, host=ip, port=int(port), log_level="info"))
+    loop = asyncio.new_event_loop()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.serve())
+
+    server_loop = loop
+    threading.Thread(target=run, name="map-server", daemon=True).start()
+    return server
+
+# tile routes are sync so building an index runs in the threadpool instead
+# of blocking the websocket updates
+@app.get("/tiles/{id}/meta")
+def tiles_meta(id: str):
+    version, index = get_tile_index(id)
+    if index is None:
+        raise HTTPException(status_code=404, detail="no svg yet")
+
+    return JSONResponse({"generation": version, **index.meta()})
+
+@app.get("/tiles/{id}/{z}/{x}/{y}")
+def tile(id: str, z: int, x: int, y: int, g: int = None):
+    version, index = get_tile_index(id)
+    if index is None:
+        raise HTTPException(status_code=404, detail="no svg yet")
+
+    svg = index.tile(z, x, y)
+    if svg is None:
+        raise HTTPException(status_code=404, detail="tile outside of the map")
+
+    # urls carry the version, a tile of a version never changes
+    headers = {"Cache-Control": "public, max-age=31536000, immutable"} if g == version else {"Cache-Control": "no-cache"}
+    return Response(svg, media_type="image/svg+xml", headers=headers)
 
 
 @app.websocket("/ws")
 async def ws(ws: WebSocket):
     await ws.accept()
-    clients.add(ws)
+    client = Client(ws)
+    clients.add(client)
     try:
         while True:
             await ws.receive_text()
+    except WebSocketDisconnect:
+        pass
     finally:
-        clients.remove(ws)
\ No newline at end of file
+        clients.discard(client)
+        client.task.cancel()
\ No newline at end of file
@@ -0,0 +1,275 @@
+import copy
+import re
+import threading
+
+import numpy as np
+import shapely
+from lxml import etree
+
+from src.mesh_handling.load_mesh import as_polygon_list, compact_path_data
+
+TILE_SIZE = 256
+MAX_ZOOM = 6
+TILE_PRECISION = 2
+# tiles kept per map before the cache starts over
+TILE_CACHE_SIZE = 2048
+# icons are drawn around their position, items this close to a tile are put
+# into it as well and cut by the tile edge
+ITEM_MARGIN = 4
+
+SVG_NS = ' xmlns="http://www.w3.org/2000/svg"'
+VIEWBOX = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+TRANSLATE = re.compile(r"translate\(\s*([-+0-9.eE]+)[\s,]+([-+0-9.eE]+)\s*\)")
+PATH_TOKEN = re.compile(r"[MmLlZz]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+
+def parse_path(d):
+    """
+    Rings of the path data written by load_mesh, only M/m, L/l and Z/z.
+    """
+    rings = []
+    ring = []
+    command = "M"
+    x = y = 0.0
+    start = (0.0, 0.0)
+    numbers = []
+
+    for token in PATH_TOKEN.findall(d):
+        if token in "MmLlZz":
+            command = token
+            if command in "Zz":
+                if ring:
+                    rings.append(ring)
+                ring = []
+                x, y = start
+            continue
+
+        numbers.append(float(token))
+        if len(numbers) < 2:
+            continue
+
+        dx, dy = numbers
+        numbers = []
+
+        if command in "ml":
+            x, y = x + dx, y + dy
+        else:
+            x, y = dx, dy
+
+        if command in "Mm":
+            if ring:
+                rings.append(ring)
+            ring = []
+            start = (x, y)
+            # coordinates after a moveto are linetos
+            command = "l" if command == "m" else "L"
+
+        ring.append((x, y))
+
+    if ring:
+        rings.append(ring)
+
+    return [ring for ring in rings if len(ring) >= 3]
+
+
+def path_polygon(d):
+    rings = parse_path(d)
+    if not rings:
+        return None
+
+    polygon = shapely.Polygon(rings[0], rings[1:])
+    if not polygon.is_valid:
+        polygon = shapely.make_valid(polygon)
+    return polygon
+
+
+def element_markup(element):
+    # every child repeats the namespace of the document, tiles declare it once
+    return etree.tostring(element, encoding="unicode", with_tail=False).replace(SVG_NS, "")
+
+
+def split_elements(root):
+    """
+    The children of `root` sorted into (shared markup, floor polygons, floor
+    fills, item positions, item markup).
+    """
+    # defs and unplaced elements, like the grid background, go into every tile
+    shared = []
+    floor = []
+    fills = []
+    positions = []
+    items = []
+
+    for child in root:
+        if not isinstance(child.tag, str):
+            continue
+
+        tag = etree.QName(child).localname
+
+        if tag == "path" and child.get("d"):
+            polygon = path_polygon(child.get("d"))
+            if polygon is not None and not polygon.is_empty:
+                floor.append(polygon)
+                fills.append(child.get("fill", "black"))
+            continue
+
+        match = TRANSLATE.search(child.get("transform", ""))
+        if tag != "defs" and match:
+            positions.append((float(match.group(1)), float(match.group(2))))
+            items.append(element_markup(child))
+        else:
+            shared.append(element_markup(child))
+
+    return shared, floor, fills, positions, items
+
+
+def point_tree(positions):
+    return shapely.STRtree(shapely.points(np.asarray(positions, dtype=float).reshape(-1, 2)))
+
+
+class TileIndex:
+    """
+    Spatial index over one posted map. The floor polygons and the placed
+    items go into STRtrees so a tile only touches what it overlaps. Items
+    appended by overlays are indexed on their own, see with_overlay.
+    """
+
+    def __init__(self, svg):
+        if isinstance(svg, str):
+            svg = svg.encode("utf-8")
+        root = etree.fromstring(svg)
+
+        view_box = [float(v) for v in VIEWBOX.findall(root.get("viewBox", ""))]
+        if len(view_box) != 4:
+            view_box = [0, 0, 1, 1]
+        self.min_x, self.min_y, self.width, self.height = view_box
+        self.extent = max(self.width, self.height)
+
+        self.shared, floor, self.floor_fills, positions, self.items = split_elements(root)
+
+        self.floor = np.asarray(floor, dtype=object)
+        self.floor_tree = shapely.STRtree(self.floor)
+        self.item_tree = point_tree(positions)
+
+        # items of the overlays since the map was posted
+        self.overlay_positions = []
+        self.overlay_items = []
+        self.overlay_tree = None
+
+        # floor part of every tile, shared by the overlay versions
+        self.floor_cache = {}
+        self.floor_lock = threading.Lock()
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def with_overlay(self, fragments):
+        """
+        Index of this map with the overlay `fragments` appended, or None if
+        they draw floor and it has to be built again. The floor, its tree and
+        the floor of cached tiles are shared, only the new items are read.
+        """
+        root = etree.fromstring(b"<svg" + SVG_NS.encode() + b">" + b"".join(fragments) + b"</svg>")
+        shared, floor, _fills, positions, items = split_elements(root)
+        if floor:
+            return None
+
+        index = copy.copy(self)
+        index.shared = self.shared + shared
+        index.overlay_positions = self.overlay_positions + positions
+        index.overlay_items = self.overlay_items + items
+        index.overlay_tree = point_tree(index.overlay_positions)
+        index.cache = {}
+        index.lock = threading.Lock()
+        return index
+
+    def meta(self):
+        return {
+            "min_x": self.min_x,
+            "min_y": self.min_y,
+            "width": self.width,
+            "height": self.height,
+            "extent": self.extent,
+            "max_zoom": MAX_ZOOM,
+            "tile_size": TILE_SIZE,
+        }
+
+    def tile_bounds(self, z, x, y):
+        size = self.extent / 2 ** z
+        x0 = self.min_x + x * size
+        y0 = self.min_y + y * size
+        return x0, y0, x0 + size, y0 + size
+
+    def tile(self, z, x, y):
+        """
+        Svg of one tile or None if it is outside of the map.
+        """
+        if not (0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return None
+
+        key = (z, x, y)
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+
+        svg = self.render_tile(z, x, y)
+
+        with self.lock:
+            if len(self.cache) >= TILE_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[key] = svg
+
+        return svg
+
+    def render_tile(self, z, x, y):
+        x0, y0, x1, y1 = self.tile_bounds(z, x, y)
+        size = x1 - x0
+        tile_box = shapely.box(x0, y0, x1, y1)
+
+        parts = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="{x0} {y0} {size} {size}" '
+            f'width="{TILE_SIZE}" height="{TILE_SIZE}" overflow="hidden">'
+        ]
+        parts.extend(self.shared)
+
+        # ---- floor, cut to the tile ----
+        parts.append(self.tile_floor(z, x, y, tile_box))
+
+        # ---- items, whole, the tile edge cuts them ----
+        item_box = shapely.box(x0 - ITEM_MARGIN, y0 - ITEM_MARGIN, x1 + ITEM_MARGIN, y1 + ITEM_MARGIN)
+        for index in np.sort(self.item_tree.query(item_box, predicate="intersects")).tolist():
+            parts.append(self.items[index])
+        if self.overlay_tree is not None:
+            for index in np.sort(self.overlay_tree.query(item_box, predicate="intersects")).tolist():
+                parts.append(self.overlay_items[index])
+
+        parts.append("</svg>")
+        return "".join(parts)
+
+    def tile_floor(self, z, x, y, tile_box):
+        """
+        Floor paths of one tile, cut to it. Overlays never change them.
+        """
+        key = (z, x, y)
+        with self.floor_lock:
+            if key in self.floor_cache:
+                return self.floor_cache[key]
+
+        parts = []
+        hits = np.sort(self.floor_tree.query(tile_box, predicate="intersects"))
+        if len(hits):
+            clipped = shapely.intersection(self.floor[hits], tile_box)
+            for index, geometry in zip(hits.tolist(), clipped.tolist()):
+                polys = as_polygon_list(geometry)
+                if not polys:
+                    continue
+                d = " ".join(compact_path_data(polys, TILE_PRECISION))
+                parts.append(f'<path d="{d}" fill="{self.floor_fills[index]}"/>')
+        floor = "".join(parts)
+
+        with self.floor_lock:
+            if len(self.floor_cache) >= TILE_CACHE_SIZE:
+                self.floor_cache.clear()
+            self.floor_cache[key] = floor
+
+        return floor
+
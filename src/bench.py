@@ -0,0 +1,223 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from src.data_loading.deserializer import load_data_binary
+from src.mesh_handling import load_mesh, svg
+from src.mesh_handling.svg import SvgDocument, add_item, get_svgs
+
+STAGES = ["deserialize", "bake", "overlay", "serialize"]
+# stages that change by less than this never count as a regression, the
+# fast ones are mostly noise
+NOISE_SECONDS = 0.01
+
+
+def spawn_items(level, dim_id):
+    """
+    (name, position, rotation) of every spawn of a dimension, named like
+    show_containers places them.
+    """
+    items = []
+    for section, name in [("container_map", None), ("small_pickups_map", "small_pickup"), ("big_pickups_map", "big_pickup")]:
+        table = level[section].get(dim_id)
+        if table is None:
+            continue
+        for _zone, _id, data in table.descriptors():
+            items.append((name or data["image"].split("_")[0], data["position"], data["rotation"]))
+    return items
+
+
+# ---- stages ----
+# every stage returns (output for the next stage, bytes that identify the output)
+
+def deserialize(path):
+    level = load_data_binary(path)
+    if level is None:
+        raise ValueError(f"could not load {path}")
+
+    parts = []
+    for dim_id, meshes in level["meshes"].items():
+        for mesh in meshes:
+            parts.append(mesh["vertices"].tobytes())
+            parts.append(mesh["triangles"].tobytes())
+    return level, b"".join(parts)
+
+
+def bake(level):
+    baked = {}
+    for dim_id, meshes in level["meshes"].items():
+        items = level["static_items"][dim_id] if dim_id < len(level["static_items"]) else []
+        baked[dim_id] = (get_svgs(meshes, items), load_mesh.get_bounds_svg_multi(meshes))
+
+    output = "\0".join(
+        "\0".join([full, *lods]) for (full, lods), _ in baked.values()
+    )
+    return (level, baked), output.encode("utf-8")
+
+
+def overlay(baked_level):
+    level, baked = baked_level
+    documents = {}
+    for dim_id, ((full, lods), bounds) in baked.items():
+        document = SvgDocument(full, lods)
+        for name, position, rotation in spawn_items(level, dim_id):
+            add_item(document, name, position, rotation, bounds)
+        documents[dim_id] = document
+
+    output = "\0".join("".join(document.defs + document.fragments) for document in documents.values())
+    return documents, output.encode("utf-8")
+
+
+def serialize(documents):
+    rendered = [document.render().encode("utf-8") for document in documents.values()]
+    return rendered, b"\0".join(rendered)
+
+
+STAGE_FUNCTIONS = {"deserialize": deserialize, "bake": bake, "overlay": overlay, "serialize": serialize}
+
+
+def run_stage(name, value, repeats, memory):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result, output = STAGE_FUNCTIONS[name](value)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    measured = {
+        "seconds": best,
+        "bytes": len(output),
+        "hash": hashlib.sha256(output).hexdigest(),
+    }
+
+    # traced in an extra run, tracemalloc slows everything down
+    if memory:
+        tracemalloc.start()
+        STAGE_FUNCTIONS[name](value)
+        measured["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result, measured
+
+
+def bench_level(path, repeats, memory):
+    results = {}
+    value = path
+    for name in STAGES:
+        value, results[name] = run_stage(name, value, repeats, memory)
+    return results
+
+
+# ---- baseline ----
+
+def compare(results, baseline, threshold):
+    """
+    Returns (problems, lines), problems are hash mismatches and stages that got
+    slower than `threshold` allows.
+    """
+    problems = 0
+    lines = []
+
+    # only levels both runs have are compared
+    common = [filename for filename in results["levels"] if filename in baseline.get("levels", {})]
+    if not common:
+        return 0, ["no level in common with the baseline"]
+
+    # everything after deserialize depends on the render settings
+    hashed = STAGES
+    if results["settings"] != baseline.get("settings"):
+        hashed = ["deserialize"]
+        lines.append(f"render settings differ from the baseline {baseline.get('settings')}, only deserialize output is compared")
+
+    for name in STAGES:
+        now = sum(results["levels"][filename][name]["seconds"] for filename in common)
+        before = sum(baseline["levels"][filename][name]["seconds"] for filename in common)
+        if not before:
+            continue
+
+        change = now / before - 1
+        slower = change > threshold and now - before > NOISE_SECONDS
+        problems += slower
+        lines.append(f"{name:<12} {before * 1000:>10.1f}ms -> {now * 1000:>10.1f}ms {change * 100:+6.1f}%" + (" REGRESSION" if slower else ""))
+
+    for filename in common:
+        for name in hashed:
+            if results["levels"][filename][name]["hash"] != baseline["levels"][filename][name]["hash"]:
+                problems += 1
+                lines.append(f"{filename} {name}: output differs from the baseline")
+
+    return problems, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times every render stage over the level files")
+    parser.add_argument("levels", nargs="*", help="only these level files, e.g. R1A1_0.bin")
+    parser.add_argument("-f", "--folder", default="resources/levels", help="folder with the level files")
+    parser.add_argument("-n", "--repeats", type=int, default=1, help="how many times every stage runs, best time is kept")
+    parser.add_argument("-o", "--output", default="bench.json", help="where the results are written")
+    parser.add_argument("-b", "--baseline", default=None, help="results of an earlier run to compare against")
+    parser.add_argument("-t", "--threshold", type=float, default=0.1, help="how much slower a stage may get before it counts as a regression, 0.1 is 10%%")
+    parser.add_argument("--memory", action="store_true", default=False, help="also record the peak memory of every stage, in an extra traced run")
+    parser.add_argument("--item-symbols", action="store_true", default=False, help="bake with --item-symbols")
+    parser.add_argument("--path-precision", type=int, default=None, help="bake with this --path-precision")
+    parser.add_argument("--lod", action="store_true", default=False, help="also bake the lod tiers")
+
+    args = parser.parse_args()
+
+    load_mesh.path_precision = args.path_precision
+    if args.item_symbols:
+        svg.item_mode = "symbol"
+    svg.lod = args.lod
+
+    filenames = args.levels or sorted(
+        filename for filename in os.listdir(args.folder) if filename.endswith(".bin")
+    )
+
+    results = {"settings": svg.render_settings(), "levels": {}, "failed": []}
+    totals = {name: 0.0 for name in STAGES}
+
+    print(f"{'level':<32} " + " ".join(f"{name:>12}" for name in STAGES))
+
+    for filename in filenames:
+        try:
+            stages = bench_level(os.path.join(args.folder, filename), args.repeats, args.memory)
+        except Exception as e:
+            print(f"{filename:<32} failed: {e}")
+            results["failed"].append(filename)
+            continue
+
+        results["levels"][filename] = stages
+        for name in STAGES:
+            totals[name] += stages[name]["seconds"]
+        print(f"{filename:<32} " + " ".join(f"{stages[name]['seconds'] * 1000:>10.1f}ms" for name in STAGES))
+
+    results["totals"] = totals
+    print(f"{'total':<32} " + " ".join(f"{totals[name] * 1000:>10.1f}ms" for name in STAGES))
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=1)
+    print(f"results: {args.output}")
+
+    if args.baseline is None:
+        return
+
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    problems, lines = compare(results, baseline, args.threshold)
+    for line in lines:
+        print(line)
+
+    if problems:
+        print(f"{problems} problems against {args.baseline}")
+        sys.exit(1)
+    print(f"same output as {args.baseline}, no stage regressed")
+
+
+if __name__ == "__main__":
+    main()
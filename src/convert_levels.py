@@ -0,0 +1,108 @@
+import argparse
+import hashlib
+import os
+import time
+
+from src.data_loading.benchmark_deserializer import same_data
+from src.data_loading.deserializer import load_data_buffer
+from src.data_loading.level_format import is_v2, write_level
+from src.data_loading.spawn_table import DescriptorList, SpawnTable
+
+
+def plain(value):
+    # tables and descriptor lists compared by what they read like
+    if isinstance(value, SpawnTable):
+        return value.to_plain()
+    if isinstance(value, DescriptorList):
+        return list(value)
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    return value
+
+
+def same_level(v1, v2):
+    # v2 files do not keep normals and uvs
+    v1 = dict(v1, meshes={
+        dimension_id: [dict(mesh, normals=None, uvs=None) for mesh in meshes]
+        for dimension_id, meshes in v1["meshes"].items()
+    })
+    return same_data(plain(v1), plain(v2))
+
+
+def convert_file(path, output, compress):
+    """
+    Converts one v1 level file, returns (v1 size, v2 size). The written file
+    is read back and compared with the original before it replaces anything.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if is_v2(data):
+        raise ValueError("already converted")
+
+    level = load_data_buffer(data)
+    converted = write_level(level, hashlib.sha256(data).digest(), compress)
+
+    if not same_level(level, load_data_buffer(converted)):
+        raise ValueError("converted level reads differently")
+
+    # written next to the target first, a half written level never replaces one
+    temp = output + ".tmp"
+    with open(temp, "wb") as f:
+        f.write(converted)
+    os.replace(temp, output)
+
+    return len(data), len(converted)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts level files to the compact v2 format")
+    parser.add_argument("levels", nargs="*", help="only convert these level files, e.g. R1A1_0.bin")
+    parser.add_argument("-f", "--folder", default="resources/levels", help="folder with the level files")
+    parser.add_argument("-o", "--output", default="resources/levels_v2", help="folder the converted files are written to")
+    parser.add_argument("--in-place", action="store_true", default=False, help="replace the files in --folder instead, load_level reads both formats")
+    parser.add_argument("--zlib", action="store_true", default=False, help="zlib compress every section it makes smaller, smaller files but sections are decompressed on load")
+
+    args = parser.parse_args()
+
+    output_folder = args.folder if args.in_place else args.output
+    os.makedirs(output_folder, exist_ok=True)
+
+    filenames = args.levels or sorted(
+        filename for filename in os.listdir(args.folder) if filename.endswith(".bin")
+    )
+
+    print(f"{'level':<32} {'v1':>10} {'v2':>10} {'ratio':>6}")
+
+    start = time.perf_counter()
+    total_before = 0
+    total_after = 0
+    failed = []
+
+    for filename in filenames:
+        try:
+            before, after = convert_file(
+                os.path.join(args.folder, filename),
+                os.path.join(output_folder, filename),
+                args.zlib,
+            )
+        except Exception as e:
+            print(f"{filename:<32} failed: {e}")
+            failed.append(filename)
+            continue
+
+        total_before += before
+        total_after += after
+        print(f"{filename:<32} {before / 1024:>8.0f}KB {after / 1024:>8.0f}KB {after / before:>6.2f}")
+
+    converted = len(filenames) - len(failed)
+    print(f"converted {converted} levels in {time.perf_counter() - start:.1f}s, {total_before / 1024 / 1024:.1f}MB -> {total_after / 1024 / 1024:.1f}MB")
+    print(f"output: {output_folder}")
+
+    if failed:
+        print(f"{len(failed)} levels failed")
+
+
+if __name__ == "__main__":
+    main()
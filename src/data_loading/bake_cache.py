@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from src.metrics import log
+from src.mesh_handling.svg import RENDERER_VERSION, render_settings
+
+CACHE_DIR = Path(tempfile.gettempdir()) / "live_gtfo_bake_cache"
+
+enabled = True
+max_cache_bytes = 512 * 1024 * 1024
+
+
+def level_hash(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_path(file_hash, dimension) -> Path:
+    # svgs baked with different settings are not interchangeable, keep them apart
+    settings = "_".join(str(value) for value in render_settings().values())
+    return CACHE_DIR / f"{file_hash}_v{RENDERER_VERSION}_{settings}_{dimension}.json"
+
+
+def load_baked(file_hash, dimension):
+    """
+    Returns {"svg": str, "bounds": [min_xy, max_xy], "lods": [str, ...]}
+    or None on a miss.
+    """
+    if not enabled or file_hash is None:
+        return None
+
+    path = cache_path(file_hash, dimension)
+
+    try:
+        with path.open("r", encoding="utf-8") as f:
+            baked = json.load(f)
+
+        # touch it so eviction drops the least recently used entries first
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning("ignoring broken bake cache entry %s: %s", path, e)
+        return None
+
+    return {
+        "svg": baked["svg"],
+        "bounds": [np.array(baked["bounds"][0]), np.array(baked["bounds"][1])],
+        "lods": baked.get("lods", []),
+    }
+
+
+def store_baked(file_hash, dimension, svg, bounds, lods=()):
+    if not enabled or file_hash is None:
+        return
+
+    path = cache_path(file_hash, dimension)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": RENDERER_VERSION,
+                    "bounds": [[float(v) for v in bounds[0]], [float(v) for v in bounds[1]]],
+                    "svg": svg,
+                    "lods": list(lods),
+                },
+                f,
+            )
+        # readers never see a half written entry
+        os.replace(tmp_path, path)
+    except Exception as e:
+        log.warning("could not write bake cache entry %s: %s", path, e)
+        return
+
+    evict(max_cache_bytes)
+
+
+def evict(max_bytes):
+    """
+    Deletes least recently used entries until the cache fits in `max_bytes`.
+    """
+    try:
+        entries = []
+        for path in CACHE_DIR.glob("*.json"):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+    except FileNotFoundError:
+        return
+
+    total = sum(size for _, size, _ in entries)
+    entries.sort()
+
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+            total -= size
+        except FileNotFoundError:
+            total -= size
+        except OSError as e:
+            log.warning("could not evict %s: %s", path, e)
+
+
+def clear():
+    for path in CACHE_DIR.glob("*.json"):
+        path.unlink(missing_ok=True)
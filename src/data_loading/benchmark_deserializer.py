@@ -0,0 +1,102 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+from src.data_loading.deserializer import load_data_binary, load_data_binary_stream
+from src.data_loading.spawn_table import DescriptorList, SpawnTable
+
+
+def same_data(a, b):
+    # the buffer loader keeps spawns as tables, the stream loader as dicts
+    if isinstance(b, SpawnTable):
+        b = b.to_plain()
+    if isinstance(b, DescriptorList):
+        b = list(b)
+
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return (
+            isinstance(a, np.ndarray)
+            and isinstance(b, np.ndarray)
+            and a.dtype == b.dtype
+            and np.array_equal(a, b)
+        )
+
+    if isinstance(a, dict):
+        return (
+            isinstance(b, dict)
+            and list(a.keys()) == list(b.keys())
+            and all(same_data(a[k], b[k]) for k in a)
+        )
+
+    if isinstance(a, (list, tuple)):
+        return (
+            type(a) is type(b)
+            and len(a) == len(b)
+            and all(same_data(x, y) for x, y in zip(a, b))
+        )
+
+    return type(a) is type(b) and a == b
+
+
+def load_full(path):
+    return load_data_binary(path, decode_extras=True)
+
+
+def time_loader(loader, paths, repeats):
+    best = None
+    results = []
+
+    for _ in range(repeats):
+        results = []
+        start = time.perf_counter()
+        for path in paths:
+            results.append(loader(path))
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--folder", default="resources/levels", help="folder with the level files")
+    parser.add_argument("-n", "--repeats", type=int, default=3, help="how many times every loader runs, best time is kept")
+
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.join(args.folder, filename)
+        for filename in os.listdir(args.folder)
+        if filename.endswith(".bin")
+    )
+
+    stream_time, stream_results = time_loader(load_data_binary_stream, paths, args.repeats)
+    buffer_time, buffer_results = time_loader(load_full, paths, args.repeats)
+    skip_time, _ = time_loader(load_data_binary, paths, args.repeats)
+
+    mismatches = [
+        path
+        for path, a, b in zip(paths, stream_results, buffer_results)
+        if not same_data(a, b)
+    ]
+
+    print(f"files:  {len(paths)}")
+    print(f"stream: {stream_time * 1000:.1f} ms")
+    print(f"buffer: {buffer_time * 1000:.1f} ms")
+    print(f"speedup: {stream_time / buffer_time:.2f}x")
+    print(f"buffer, normals/uvs skipped: {skip_time * 1000:.1f} ms")
+
+    if mismatches:
+        print(f"output differs for {len(mismatches)} files:")
+        for path in mismatches:
+            print(f"   {path}")
+    else:
+        print("output identical for all files")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import struct
+
+INT32 = struct.Struct("<i")
+BOOL = struct.Struct("<?")
+MESH_HEADER = struct.Struct("<iii")
+COUNT_PAIR = struct.Struct("<ii")
+# position.x, position.y, rotation of a ContainerDescriptor
+DESCRIPTOR_TAIL = struct.Struct("<ffi")
+
+
+class BinaryReader:
+    """
+    Walks a level file that was read into memory once, using struct offsets
+    instead of one f.read() per field. Mirrors the C# BinaryWriter layout.
+    """
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.view = memoryview(data)
+        self.offset = offset
+        self.size = len(data)
+
+    def remaining(self):
+        return self.size - self.offset
+
+    def require(self, length, what):
+        if length < 0 or self.offset + length > self.size:
+            raise EOFError(f"Unexpected EOF while reading {what}")
+
+    def skip(self, length):
+        self.require(length, "skipped block")
+        self.offset += length
+
+    def read_i32(self):
+        self.require(4, "int")
+        value = INT32.unpack_from(self.data, self.offset)[0]
+        self.offset += 4
+        return value
+
+    def read_bool(self):
+        self.require(1, "bool")
+        value = BOOL.unpack_from(self.data, self.offset)[0]
+        self.offset += 1
+        return value
+
+    def read_struct(self, fmt, what="struct"):
+        self.require(fmt.size, what)
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def read_block(self, length, what="block"):
+        """
+        Returns a zero-copy view over the next `length` bytes.
+        """
+        self.require(length, what)
+        block = self.view[self.offset:self.offset + length]
+        self.offset += length
+        return block
+
+    def read_string(self):
+        # 7-bit encoded length prefix, same as read_cs_string
+        data = self.data
+        offset = self.offset
+        shift = 0
+        length = 0
+        while True:
+            if offset >= self.size:
+                raise EOFError("Unexpected EOF while reading string length")
+            byte = data[offset]
+            offset += 1
+            length |= (byte & 0x7F) << shift
+            if (byte & 0x80) == 0:
+                break
+            shift += 7
+
+        if offset + length > self.size:
+            raise EOFError("Unexpected EOF while reading string")
+
+        self.offset = offset + length
+        return str(self.view[offset:offset + length], "utf-8")
+
+    def read_descriptor_columns(self, count, names, columns, keyed=False):
+        """
+        Reads `count` ContainerDescriptors in one tight loop and appends them
+        to the (keys, xs, ys, rotations, images) lists in `columns`, images
+        are interned into `names`. With `keyed` every descriptor is prefixed
+        by its int key, otherwise its key is its number in this block.
+        """
+        data = self.data
+        offset = self.offset
+        unpack_key = INT32.unpack_from
+        unpack_tail = DESCRIPTOR_TAIL.unpack_from
+        intern = names.intern
+        keys, xs, ys, rotations, images = columns
+
+        try:
+            for number in range(count):
+                if keyed:
+                    key = unpack_key(data, offset)[0]
+                    offset += 4
+                else:
+                    key = number
+
+                # bw.Write(cd.image);
+                length = data[offset]
+                if length & 0x80:
+                    # long string, fall back to the full 7-bit decode
+                    self.offset = offset
+                    image = self.read_string()
+                    offset = self.offset
+                else:
+                    offset += 1 + length
+                    image = data[offset - length:offset].decode("utf-8")
+
+                # bw.Write(cd.position.x); bw.Write(cd.position.y); bw.Write(cd.rotation);
+                pos_x, pos_y, rotation = unpack_tail(data, offset)
+                offset += 12
+
+                keys.append(key)
+                xs.append(pos_x)
+                ys.append(pos_y)
+                rotations.append(rotation)
+                images.append(intern(image))
+
+        except (IndexError, struct.error):
+            raise EOFError("Unexpected EOF while reading ContainerDescriptor")
+
+        self.offset = offset
+
+    def skip_descriptors(self, count, keyed=False):
+        data = self.data
+        offset = self.offset
+
+        try:
+            for _ in range(count):
+                if keyed:
+                    offset += 4
+
+                length = data[offset]
+                if length & 0x80:
+                    self.offset = offset
+                    self.read_string()
+                    offset = self.offset
+                else:
+                    offset += 1 + length
+
+                offset += DESCRIPTOR_TAIL.size
+
+        except IndexError:
+            raise EOFError("Unexpected EOF while skipping ContainerDescriptor")
+
+        # the last descriptor must still be inside the file
+        if offset > self.size:
+            raise EOFError("Unexpected EOF while skipping ContainerDescriptor")
+
+        self.offset = offset
@@ -4,6 +4,11 @@ from pathlib import Path
 
 import numpy as np
 
+from src.data_loading.binary_reader import COUNT_PAIR, MESH_HEADER, BinaryReader
+from src.data_loading.level_format import is_v2, load_v2_buffer
+from src.data_loading.spawn_table import DescriptorList, ImageNames, SpawnTable, build_rows
+from src.metrics import log
+
 
 # Helper to read a 7-bit prefixed string from C# BinaryWriter
 def read_cs_string(f):
@@ -138,7 +143,12 @@ def load_overflow_data(f):
         
     return result
 
-def load_data_binary(path: str):
+
+def load_data_binary_stream(path: str):
+    """
+    Reference reader that parses the level straight from the file object.
+    Kept to verify and benchmark `load_data_binary` against.
+    """
     path = Path(path)
 
     try:
@@ -154,7 +164,7 @@ def load_data_binary(path: str):
                 verts_len = struct.unpack("<i", f.read(4))[0]
                 tris_len = struct.unpack("<i", f.read(4))[0]
 
-                print(f"decoding size: {verts_len} and {tris_len}")
+                log.debug("decoding size: %s and %s", verts_len, tris_len)
 
                 # ---- Vertices ----
                 vertices = np.frombuffer(
@@ -177,7 +187,7 @@ def load_data_binary(path: str):
                 # ---- Normals ----
                 has_normals = struct.unpack("<?", f.read(1))[0]
                 normals = (
-                    [struct.unpack("<fff", f.read(12)) for _ in range(verts_len)]
+                    np.frombuffer(f.read(verts_len * 3 * 4), dtype="<f4").reshape(verts_len, 3)
                     if has_normals
                     else None
                 )
@@ -187,7 +197,7 @@ def load_data_binary(path: str):
                 # ---- UVs ----
                 has_uvs = struct.unpack("<?", f.read(1))[0]
                 uvs = (
-                    [struct.unpack("<ff", f.read(8)) for _ in range(verts_len)]
+                    np.frombuffer(f.read(verts_len * 2 * 4), dtype="<f4").reshape(verts_len, 2)
                     if has_uvs
                     else None
                 )
@@ -282,6 +292,204 @@ def load_data_binary(path: str):
             }
 
     except Exception as e:
-        print(e)
+        log.warning("could not load %s: %s", path, e)
+        # If *anything* is wrong (parsing, unexpected EOF, wrong format)
+        return None
+
+
+def read_dimension_spawns(reader: BinaryReader, keyed, names):
+    """
+    Reads the zones of one dimension into a SpawnTable. Spawn maps are keyed
+    by id inside a zone (`keyed`), overflow lists are plain lists.
+    """
+    zones = {}
+    columns = ([], [], [], [], [])
+    zone_count = reader.read_i32()
+
+    for _ in range(zone_count):
+        zone, inner_count = reader.read_struct(COUNT_PAIR, "zone header")
+        start = len(columns[0])
+        reader.read_descriptor_columns(inner_count, names, columns, keyed)
+        zones[zone] = (start, start + inner_count)
+
+    return SpawnTable(build_rows(columns), names, zones, keyed)
+
+
+def read_descriptor_list(reader: BinaryReader, count, names):
+    columns = ([], [], [], [], [])
+    reader.read_descriptor_columns(count, names, columns)
+    return DescriptorList(build_rows(columns), names)
+
+
+def skip_dimension_spawns(reader: BinaryReader, keyed):
+    zone_count = reader.read_i32()
+
+    for _ in range(zone_count):
+        _zone, inner_count = reader.read_struct(COUNT_PAIR, "zone header")
+        reader.skip_descriptors(inner_count, keyed)
+
+
+def read_data_inner(reader: BinaryReader, names):
+    dimension_containers = {}
+    dimensions_count = reader.read_i32()
+
+    for _ in range(dimensions_count):
+        out_key = reader.read_i32()
+        dimension_containers[out_key] = read_dimension_spawns(reader, True, names)
+
+    return dimension_containers
+
+
+def read_overflow_data(reader: BinaryReader, names):
+    result = {}
+    outer_count = reader.read_i32()
+
+    for _ in range(outer_count):
+        out_key = reader.read_i32()
+        result[out_key] = read_dimension_spawns(reader, False, names)
+
+    return result
+
+
+def read_static_items(reader: BinaryReader, names):
+    static_items = []
+    statics_dimensions_count = reader.read_i32()
+
+    for _ in range(statics_dimensions_count):
+        statics_count = reader.read_i32()
+        static_items.append(read_descriptor_list(reader, statics_count, names))
+
+    return static_items
+
+
+def read_vector_block(reader: BinaryReader, count, width, decode, what):
+    length = count * width * 4
+
+    if not decode:
+        reader.skip(length)
+        return None
+
+    return np.frombuffer(reader.read_block(length, what), dtype="<f4").reshape(count, width)
+
+
+def skip_mesh(reader: BinaryReader):
+    """
+    Skips one mesh block, returns its dimension id.
+    """
+    dimension_id, verts_len, tris_len = reader.read_struct(MESH_HEADER, "mesh header")
+    reader.skip(verts_len * 3 * 4 + tris_len * 4)
+
+    if reader.read_bool():
+        reader.skip(verts_len * 3 * 4)
+    if reader.read_bool():
+        reader.skip(verts_len * 2 * 4)
+
+    return dimension_id
+
+
+def read_mesh(reader: BinaryReader, decode_extras=False):
+    """
+    Reads one mesh block, returns (dimension_id, mesh).
+    Normals and UVs are not used for rendering so by default their blocks are
+    skipped and left as None. With `decode_extras` they are returned as
+    float32 arrays viewing the file buffer.
+    """
+    data = reader.data
+    offset = reader.offset
+
+    dimension_id, verts_len, tris_len = reader.read_struct(MESH_HEADER, "mesh header")
+
+    log.debug("decoding size: %s and %s", verts_len, tris_len)
+
+    offset += MESH_HEADER.size
+    verts_end = offset + verts_len * 3 * 4
+    tris_end = verts_end + tris_len * 4
+    # one bool after the triangles, at least one more after the normals
+    reader.require(tris_end + 2 - offset, "mesh data")
+
+    # ---- Vertices ----
+    vertices = np.frombuffer(
+        data, dtype="<f4", count=verts_len * 3, offset=offset  # little-endian float32
+    ).reshape(verts_len, 3)
+
+    # ---- Triangles ----
+    triangles = np.frombuffer(data, dtype="<i4", count=tris_len, offset=verts_end)
+    if triangles.size % 3 == 0:
+        triangles = triangles.reshape(-1, 3)
+
+    reader.offset = tris_end
+
+    # ---- Normals ----
+    normals = None
+    if reader.read_bool():
+        normals = read_vector_block(reader, verts_len, 3, decode_extras, "normals")
+
+    # ---- UVs ----
+    uvs = None
+    if reader.read_bool():
+        uvs = read_vector_block(reader, verts_len, 2, decode_extras, "uvs")
+
+    return dimension_id, {
+        "vertices": vertices,
+        "triangles": triangles,
+        "normals": normals,
+        "uvs": uvs,
+    }
+
+
+def load_data_buffer(data, decode_extras=False):
+    """
+    Parses a whole level file already held in memory (bytes / bytearray / mmap).
+    """
+    if is_v2(data):
+        return load_v2_buffer(data)
+
+    reader = BinaryReader(data)
+
+    mesh_count = reader.read_i32()
+    meshes = {}
+
+    for _ in range(mesh_count):
+        dimension_id, mesh = read_mesh(reader, decode_extras)
+        meshes.setdefault(dimension_id, []).append(mesh)
+
+    # every image name of the level is kept once
+    names = ImageNames()
+
+    containers = read_data_inner(reader, names)
+    small_pickups = read_data_inner(reader, names)
+    big_pickups = read_data_inner(reader, names)
+
+    overflow_containers = read_overflow_data(reader, names)
+    overflow_small_pickups = read_overflow_data(reader, names)
+    overflow_big_pickups = read_overflow_data(reader, names)
+
+    static_items = read_static_items(reader, names)
+
+    return {
+        "meshes": meshes,
+        "container_map": containers,
+        "small_pickups_map": small_pickups,
+        "big_pickups_map": big_pickups,
+        "static_items": static_items,
+        "overflow_containers": overflow_containers,
+        "overflow_small_pickups": overflow_small_pickups,
+        "overflow_big_pickups": overflow_big_pickups,
+    }
+
+
+def load_data_binary(path: str, decode_extras=False):
+    """
+    Loads a level file. Normals and UVs are only decoded with `decode_extras`,
+    the renderer never needs them.
+    """
+    path = Path(path)
+
+    try:
+        # one read for the whole file, everything else works on offsets
+        return load_data_buffer(path.read_bytes(), decode_extras)
+
+    except Exception as e:
+        log.warning("could not load %s: %s", path, e)
         # If *anything* is wrong (parsing, unexpected EOF, wrong format)
         return None
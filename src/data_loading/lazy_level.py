@@ -0,0 +1,250 @@
+import threading
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+
+from src.data_loading.bake_cache import level_hash
+from src.data_loading.binary_reader import BinaryReader
+from src.data_loading import level_format
+from src.data_loading.deserializer import (
+    read_descriptor_list,
+    read_dimension_spawns,
+    read_mesh,
+    skip_dimension_spawns,
+    skip_mesh,
+)
+from src import metrics
+from src.metrics import log
+from src.data_loading.spawn_table import ImageNames
+
+SPAWN_SECTIONS = ["container_map", "small_pickups_map", "big_pickups_map"]
+OVERFLOW_SECTIONS = ["overflow_containers", "overflow_small_pickups", "overflow_big_pickups"]
+
+
+class LoaderLocks:
+    """
+    One lock per key, a value that is being built in one thread is waited
+    for instead of being built again in another.
+    """
+
+    def __init__(self):
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, key):
+        with self.lock:
+            if key not in self.locks:
+                self.locks[key] = threading.RLock()
+            return self.locks[key]
+
+
+def load_once(container, key):
+    # values are only ever added, a built one needs no lock
+    if key in container.values:
+        return container.values[key]
+
+    with container.lock_for(key):
+        if key not in container.values:
+            container.values[key] = container.loaders[key]()
+        return container.values[key]
+
+
+class LazyMap(Mapping):
+    """
+    Read-only dict whose values are built by their loader on first access.
+    """
+
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self.values = {}
+        self.lock_for = LoaderLocks()
+
+    def __getitem__(self, key):
+        if key not in self.loaders:
+            raise KeyError(key)
+        return load_once(self, key)
+
+    def __iter__(self):
+        return iter(self.loaders)
+
+    def __len__(self):
+        return len(self.loaders)
+
+    def is_loaded(self, key):
+        return key in self.values
+
+
+class LazyList(Sequence):
+    """
+    Read-only list whose items are built by their loader on first access.
+    """
+
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self.values = {}
+        self.lock_for = LoaderLocks()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self.loaders))[index]]
+
+        if index < 0:
+            index += len(self.loaders)
+        if not 0 <= index < len(self.loaders):
+            raise IndexError(index)
+        return load_once(self, index)
+
+    def __len__(self):
+        return len(self.loaders)
+
+    def is_loaded(self, index):
+        return index in self.values
+
+    def preload(self, index, value):
+        """
+        Stores an item that was built elsewhere, its loader is never called.
+        """
+        self.values[index] = value
+
+
+def scan_level(data):
+    """
+    Walks the level once without decoding anything and returns the offset of
+    every section:
+        meshes:        {dimension_id: [mesh offset, ...]}
+        spawn maps and
+        overflows:     {section: {dimension_id: offset}}
+        static_items:  [offset per dimension]
+    """
+    reader = BinaryReader(data)
+    offsets = {"meshes": {}}
+
+    mesh_count = reader.read_i32()
+    for _ in range(mesh_count):
+        mesh_offset = reader.offset
+        dimension_id = skip_mesh(reader)
+        offsets["meshes"].setdefault(dimension_id, []).append(mesh_offset)
+
+    for section in SPAWN_SECTIONS + OVERFLOW_SECTIONS:
+        keyed = section in SPAWN_SECTIONS
+        dimensions = {}
+
+        dimensions_count = reader.read_i32()
+        for _ in range(dimensions_count):
+            dimension_id = reader.read_i32()
+            dimensions[dimension_id] = reader.offset
+            skip_dimension_spawns(reader, keyed)
+
+        offsets[section] = dimensions
+
+    statics = []
+    statics_dimensions_count = reader.read_i32()
+    for _ in range(statics_dimensions_count):
+        statics.append(reader.offset)
+        reader.skip_descriptors(reader.read_i32())
+
+    offsets["static_items"] = statics
+
+    return offsets
+
+
+def lazy_level_from_buffer(data, decode_extras=False):
+    """
+    Same dict as load_data_buffer but every dimension of every section is
+    only decoded when it is first accessed. Reads both the v1 files and the
+    v2 ones written by src.convert_levels.
+    """
+    if level_format.is_v2(data):
+        return lazy_v2_level(data)
+
+    with metrics.span("deserialize"):
+        offsets = scan_level(data)
+    # every image name of the level is kept once, whichever section is first
+    names = ImageNames()
+
+    def mesh_loader(mesh_offsets):
+        def load():
+            meshes = []
+            with metrics.span("deserialize"):
+                for offset in mesh_offsets:
+                    _dimension_id, mesh = read_mesh(BinaryReader(data, offset), decode_extras)
+                    meshes.append(mesh)
+            return meshes
+        return load
+
+    def spawns_loader(offset, keyed):
+        def load():
+            with metrics.span("deserialize"):
+                return read_dimension_spawns(BinaryReader(data, offset), keyed, names)
+        return load
+
+    def statics_loader(offset):
+        def load():
+            reader = BinaryReader(data, offset)
+            return read_descriptor_list(reader, reader.read_i32(), names)
+        return load
+
+    level = {
+        # identifies the file content for the persistent bake cache
+        "source_hash": level_hash(data),
+        # the sections below keep the whole file alive
+        "source_size": len(data),
+        "meshes": LazyMap({
+            dimension_id: mesh_loader(mesh_offsets)
+            for dimension_id, mesh_offsets in offsets["meshes"].items()
+        }),
+        "static_items": LazyList([statics_loader(offset) for offset in offsets["static_items"]]),
+    }
+
+    for section in SPAWN_SECTIONS + OVERFLOW_SECTIONS:
+        keyed = section in SPAWN_SECTIONS
+        level[section] = LazyMap({
+            dimension_id: spawns_loader(offset, keyed)
+            for dimension_id, offset in offsets[section].items()
+        })
+
+    return level
+
+
+def lazy_v2_level(data):
+    level = {"decompressed_size": 0}
+    lock = threading.Lock()
+
+    def decompressed(size):
+        with lock:
+            level["decompressed_size"] += size
+
+    with metrics.span("deserialize"):
+        loaders = level_format.level_loaders(data, decompressed)
+
+    def timed(load):
+        def timed_load():
+            with metrics.span("deserialize"):
+                return load()
+        return timed_load
+
+    # hash of the v1 file it was converted from, baked levels carry over
+    level["source_hash"] = loaders["source_hash"]
+    level["source_size"] = len(data)
+    level["meshes"] = LazyMap({
+        dimension_id: timed(load) for dimension_id, load in loaders["meshes"].items()
+    })
+    level["static_items"] = LazyList([timed(load) for load in loaders["static_items"]])
+
+    for section in SPAWN_SECTIONS + OVERFLOW_SECTIONS:
+        level[section] = LazyMap({
+            dimension_id: timed(load) for dimension_id, load in loaders[section].items()
+        })
+
+    return level
+
+
+def load_lazy_level(path: str, decode_extras=False):
+    path = Path(path)
+
+    try:
+        return lazy_level_from_buffer(path.read_bytes(), decode_extras)
+
+    except Exception as e:
+        log.warning("could not load %s: %s", path, e)
+        # same contract as load_data_binary, None if the file is unusable
+        return None
@@ -1,28 +1,184 @@
-from src.data_loading.deserializer import load_data_binary
-from src.mesh_handling.svg import get_svg
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from src import metrics
+from src.data_loading.bake_cache import load_baked, store_baked
+from src.data_loading.lazy_level import LazyList, load_lazy_level
+from src.data_loading.level_cache import LevelCache
+from src.mesh_handling.load_mesh import get_bounds_svg_multi
+from src.mesh_handling.svg import apply_render_settings, get_svgs, render_settings
+from src.metrics import log
 # import trimesh
 
-level_cache = {}
+LEVELS_DIR = "resources/levels"
+
+# loaded levels are dropped least recently used first once they hold more
+# than this, the level being played is always kept
+max_level_cache_bytes = 256 * 1024 * 1024
+level_cache = LevelCache(max_level_cache_bytes)
+
+# dimensions of a level are baked in this many processes, 1 bakes them
+# one after the other in this process
+bake_workers = min(4, os.cpu_count() or 1)
+bake_pool = None
+
+# levels are loaded and baked in the background as soon as the game names
+# them, the render at the end of generation then finds them ready
+prefetch_enabled = True
+prefetch_executor = None
+# a newer prefetch makes the running one stale and cancels the queued one
+prefetch_generation = 0
+prefetch_future = None
+
+# one lock per level key, a level that is being loaded is waited for
+loading_locks = {}
+loading_locks_lock = threading.Lock()
+
+
+def level_path(level_name, marker):
+    return f"{LEVELS_DIR}/{level_name}_{marker}.bin"
+
+
+def level_markers(level_name):
+    """
+    Markers of every file there is for `level_name`.
+    """
+    prefix = f"{level_name}_"
+    try:
+        filenames = os.listdir(LEVELS_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        filename[len(prefix):-len(".bin")]
+        for filename in filenames
+        if filename.startswith(prefix) and filename.endswith(".bin")
+    )
+
+
+def level_key(level_name, marker):
+    # levels without a file of their own marker use the _0 one, both names
+    # of that file share one cache entry
+    marker = str(marker)
+    if marker != "0" and not os.path.exists(level_path(level_name, marker)):
+        marker = "0"
+    return level_name, marker
+
+
+def loading_lock(key):
+    with loading_locks_lock:
+        if key not in loading_locks:
+            loading_locks[key] = threading.Lock()
+        return loading_locks[key]
+
 
+def load_level(level_name, marker, active=True):
+    """
+    The level from the cache or read from its file. `active` pins it as the
+    level being played, prefetches leave the pin alone.
+    """
+    key = level_key(level_name, marker)
 
-def load_level(level_name, marker):
-    if (level_name, marker) in level_cache:
-        return level_cache[(level_name, marker)]
+    with loading_lock(key):
+        # a level that was evicted since is read again
+        found, loaded = level_cache.use(key, active)
+        if found:
+            return loaded
 
-    print(f"fed marker {marker}")
+        loaded = read_level(*key)
+        level_cache.put(key, loaded)
+        return loaded
 
-    loaded = load_data_binary(f"resources/levels/{level_name}_{marker}.bin")
 
-    if loaded is None:
-        loaded = load_data_binary(f"resources/levels/{level_name}_0.bin")
+def read_level(level_name, marker):
+    log.info("loading %s with marker %s", level_name, marker)
+
+    # sections are only decoded on first access, see lazy_level
+    loaded = load_lazy_level(level_path(level_name, marker))
+
+    if loaded is None and marker != "0":
+        loaded = load_lazy_level(level_path(level_name, 0))
 
     if loaded is not None:
-        loaded["dimensions_svgs"] = build_loaded_extra_data(loaded)
+        baked = build_loaded_extra_data(loaded)
+        loaded["dimensions_baked"] = baked
+        loaded["dimensions_svgs"] = LazyList(
+            [lambda i=i: baked[i]["svg"] for i in range(len(baked))]
+        )
+        loaded["dimensions_bounds"] = LazyList(
+            [lambda i=i: baked[i]["bounds"] for i in range(len(baked))]
+        )
+        loaded["dimensions_lods"] = LazyList(
+            [lambda i=i: baked[i]["lods"] for i in range(len(baked))]
+        )
 
-    level_cache[(level_name, marker)] = loaded
     return loaded
 
 
+def prefetch_level(level_name, marker=None, dimensions=None):
+    """
+    Loads and bakes a level in the background. Without a marker the level
+    is only prefetched when it has a single file, otherwise it is not known
+    yet which one will be played. Whatever an earlier call still had to do
+    is given up, only the level the game named last is prefetched.
+    """
+    global prefetch_executor, prefetch_generation, prefetch_future
+
+    if not prefetch_enabled:
+        return None
+
+    prefetch_generation += 1
+    if prefetch_future is not None and prefetch_future.cancel():
+        metrics.count("prefetches_cancelled")
+
+    if marker is None:
+        markers = level_markers(level_name)
+        if len(markers) != 1:
+            return None
+        marker = markers[0]
+
+    if prefetch_executor is None:
+        # one worker, prefetches of one generation happen in order
+        prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+    prefetch_future = prefetch_executor.submit(prefetch_task, level_name, marker, dimensions, prefetch_generation)
+    return prefetch_future
+
+
+def prefetch_stale(token):
+    if token == prefetch_generation:
+        return False
+    metrics.count("prefetches_abandoned")
+    return True
+
+
+def prefetch_task(level_name, marker, dimensions, token):
+    """
+    Loads and bakes one level, `token` is the prefetch_generation it was
+    started for. Once a newer prefetch was asked for it stops before it
+    takes the bake pool away from the level that is played.
+    """
+    try:
+        with metrics.span("prefetch"):
+            if prefetch_stale(token):
+                return
+            loaded = load_level(level_name, marker, active=False)
+            if loaded is None or prefetch_stale(token):
+                return
+
+            baked = loaded["dimensions_baked"]
+            indices = [i for i in (range(len(baked)) if dimensions is None else dimensions) if 0 <= i < len(baked)]
+            bake_dimensions(loaded, indices)
+
+            # whatever the pool did not take is baked here
+            for i in indices:
+                if prefetch_stale(token):
+                    return
+                baked[i]
+    except Exception as e:
+        log.warning("prefetch of %s %s failed: %s", level_name, marker, e)
+
+
 '''
 def show_svg(vertices, triangles):
     print(len(vertices))
@@ -32,21 +188,149 @@ def show_svg(vertices, triangles):
     mesh.show()
 '''
 
+def get_bake_pool():
+    global bake_pool
+
+    if bake_workers <= 1:
+        return None
+
+    if bake_pool is None:
+        bake_pool = ProcessPoolExecutor(max_workers=bake_workers)
+    return bake_pool
+
+
+def bake_dimension(meshes, items, settings):
+    """
+    Bakes one dimension, runs in the bake pool so the render settings are
+    passed in instead of read from this process.
+    """
+    apply_render_settings(settings)
+
+    with metrics.span("bake"):
+        svg, lods = get_svgs(meshes, items)
+        bounds = get_bounds_svg_multi(meshes)
+
+    return {"svg": svg, "bounds": bounds, "lods": lods}
+
+
+def pooled_bake(meshes, items, settings):
+    """
+    bake_dimension in a pool process, its timings go back with the result.
+    """
+    metrics.reset()
+    baked = bake_dimension(meshes, items, settings)
+    baked["metrics"] = metrics.export()
+    return baked
+
+
+def bake_dimensions(loaded, indices):
+    """
+    Bakes the given dimensions of a level loaded by load_level at the same
+    time, so the wait is the slowest dimension instead of the sum of all of
+    them. Dimensions that are cached, already baked or fail in the pool are
+    left to the serial path of dimensions_baked.
+    """
+    baked = loaded["dimensions_baked"]
+
+    indices = [i for i in indices if 0 <= i < len(baked) and not baked.is_loaded(i)]
+    if len(indices) < 2:
+        return
+
+    pool = get_bake_pool()
+    if pool is None:
+        return
+
+    # dimensions another thread is already baking are left to it, readers of
+    # a claimed dimension wait until it is preloaded
+    claimed = {}
+    for i in indices:
+        lock = baked.lock_for(i)
+        if lock.acquire(blocking=False):
+            claimed[i] = lock
+
+    try:
+        bake_claimed(loaded, [i for i in claimed if not baked.is_loaded(i)], pool)
+    finally:
+        for lock in claimed.values():
+            lock.release()
+
+
+def bake_claimed(loaded, indices, pool):
+    global bake_pool
+
+    baked = loaded["dimensions_baked"]
+    dimension_ids = list(loaded["meshes"].keys())
+    items_per_dimension = loaded["static_items"]
+    source_hash = loaded.get("source_hash")
+
+    futures = {}
+    try:
+        for i in indices:
+            dim_id = dimension_ids[i]
+
+            cached = load_baked(source_hash, dim_id)
+            if cached is not None:
+                metrics.count("bake_cache_hits")
+                baked.preload(i, cached)
+                continue
+
+            items = []
+            if dim_id < len(items_per_dimension):
+                items = items_per_dimension[dim_id]
+
+            futures[i] = pool.submit(
+                pooled_bake, loaded["meshes"][dim_id], items, render_settings()
+            )
+    except Exception as e:
+        log.warning("could not start parallel bake: %s", e)
+
+    for i, future in futures.items():
+        try:
+            result = future.result()
+        except BrokenProcessPool as e:
+            log.warning("bake pool died, baking serially: %s", e)
+            bake_pool = None
+            continue
+        except Exception as e:
+            log.warning("parallel bake of dimension %s failed, baking serially: %s", i, e)
+            continue
+
+        metrics.merge(result.pop("metrics", {}))
+        metrics.count("bake_cache_misses")
+        store_baked(source_hash, dimension_ids[i], result["svg"], result["bounds"], result["lods"])
+        baked.preload(i, result)
+
+
 def build_loaded_extra_data(loaded):
+    """
+    One baked {"svg", "bounds", "lods"} per dimension. Each dimension is only
+    baked (and its mesh decoded) the first time it is requested, and is read
+    from the persistent bake cache when this exact level file was baked
+    before.
+    """
     meshes_per_dimension = loaded["meshes"]
     items_per_dimension = loaded["static_items"]
+    source_hash = loaded.get("source_hash")
+
+    def bake(dim_id):
+        def load():
+            baked = load_baked(source_hash, dim_id)
+            if baked is not None:
+                metrics.count("bake_cache_hits")
+                return baked
+            metrics.count("bake_cache_misses")
+
+            meshes = meshes_per_dimension[dim_id]
+            items = []
+            if dim_id < len(items_per_dimension):
+                items = items_per_dimension[dim_id]
 
-    svgs = []
+            # show_svg(vertices, triangles)
 
-    for dim_id in meshes_per_dimension.keys():
-        meshes = meshes_per_dimension[dim_id]
-        items = []
-        if dim_id < len(items_per_dimension): 
-            items = items_per_dimension[dim_id]
-        
-        # show_svg(vertices, triangles)
+            baked = bake_dimension(meshes, items, render_settings())
+            store_baked(source_hash, dim_id, baked["svg"], baked["bounds"], baked["lods"])
 
-        svg = get_svg(meshes, items)
-        svgs.append(svg)
+            return baked
+        return load
 
-    return svgs
+    return LazyList([bake(dim_id) for dim_id in meshes_per_dimension.keys()])
@@ -0,0 +1,187 @@
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from src import metrics
+from src.data_loading.lazy_level import LazyList, LazyMap
+from src.data_loading.spawn_table import DescriptorList, ImageNames, SpawnTable
+from src.metrics import log
+
+
+def held_bytes(value, seen=None):
+    """
+    Bytes `value` keeps alive, shared objects are counted once and arrays that
+    view another buffer (meshes view the level file) are not counted at all.
+    """
+    if seen is None:
+        seen = set()
+    if value is None or id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes if value.base is None else 0
+    if isinstance(value, (str, bytes, bytearray)):
+        return sys.getsizeof(value)
+    if isinstance(value, (LazyMap, LazyList)):
+        # only what was already decoded or baked
+        return held_bytes(value.values, seen)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(held_bytes(v, seen) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(held_bytes(v, seen) for v in value)
+    if isinstance(value, SpawnTable):
+        return held_bytes([value.rows, value.names, value.index_keys, value.index_rows], seen)
+    if isinstance(value, DescriptorList):
+        return held_bytes([value.rows, value.names], seen)
+    if isinstance(value, ImageNames):
+        return held_bytes(value.names, seen)
+    return sys.getsizeof(value)
+
+
+def level_bytes(loaded):
+    if loaded is None:
+        return 0
+    # the file buffer the lazy sections read from is only held by closures,
+    # so are the buffers of decompressed sections their arrays view
+    return loaded.get("source_size", 0) + loaded.get("decompressed_size", 0) + held_bytes(loaded)
+
+
+class LevelCache:
+    """
+    Loaded levels by (level_name, marker), least recently used first out once
+    they hold more than `max_bytes`. Levels grow as their dimensions are baked
+    so sizes are taken again on every trim. Pinned levels are never evicted.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.levels = OrderedDict()
+        self.pinned = set()
+        self.active = None
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.levels
+
+    def __len__(self):
+        with self.lock:
+            return len(self.levels)
+
+    def lookup(self, key):
+        """
+        (True, level) on a hit and (False, None) on a miss, both are counted.
+        A level whose file could not be read is cached as None.
+        """
+        with self.lock:
+            if key not in self.levels:
+                self.misses += 1
+                metrics.count("level_cache_misses")
+                return False, None
+
+            self.hits += 1
+            metrics.count("level_cache_hits")
+            self.levels.move_to_end(key)
+            return True, self.levels[key]
+
+    def use(self, key, active=True):
+        """
+        lookup under the lock of the cache. With `active` the level is pinned
+        as the one being played first, so nothing evicts it between the pin
+        and the lookup. Levels grow while they are baked, the budget is
+        checked on every use.
+        """
+        with self.lock:
+            if active:
+                self.set_active(key)
+            found, loaded = self.lookup(key)
+            if found:
+                self.trim()
+            return found, loaded
+
+    def put(self, key, loaded):
+        with self.lock:
+            self.levels[key] = loaded
+            self.levels.move_to_end(key)
+            self.trim()
+
+    def pin(self, key):
+        with self.lock:
+            self.pinned.add(key)
+
+    def unpin(self, key):
+        with self.lock:
+            self.pinned.discard(key)
+
+    def set_active(self, key):
+        """
+        Pins the level that is being played, the previous one becomes a
+        normal entry again.
+        """
+        with self.lock:
+            if self.active is not None and self.active != key:
+                self.pinned.discard(self.active)
+            self.active = key
+            self.pinned.add(key)
+
+    def sizes(self):
+        with self.lock:
+            return {key: level_bytes(loaded) for key, loaded in self.levels.items()}
+
+    def trim(self):
+        """
+        Evicts least recently used levels until the rest fits the budget.
+        """
+        with self.lock:
+            sizes = self.sizes()
+            total = sum(sizes.values())
+
+            for key in list(self.levels):
+                if total <= self.max_bytes:
+                    break
+                if key in self.pinned:
+                    continue
+
+                del self.levels[key]
+                total -= sizes[key]
+                self.evictions += 1
+                self.evicted_bytes += sizes[key]
+                metrics.count("level_cache_evictions")
+                log.info("evicted level %s %s (%.1fMB)", key[0], key[1], sizes[key] / 1024 / 1024)
+
+            metrics.gauge("level_cache_bytes", total)
+            metrics.gauge("level_cache_levels", len(self.levels))
+            return total
+
+    def clear(self):
+        with self.lock:
+            self.levels.clear()
+
+    def stats(self):
+        with self.lock:
+            sizes = self.sizes()
+            return {
+                "levels": len(self.levels),
+                "bytes": sum(sizes.values()),
+                "max_bytes": self.max_bytes,
+                "pinned": len(self.pinned & set(self.levels)),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+            }
+
+    def summary(self):
+        stats = self.stats()
+        return (
+            f"level cache {stats['levels']} levels {stats['bytes'] / 1024 / 1024:.1f}/{stats['max_bytes'] / 1024 / 1024:.0f}MB"
+            f" hits {stats['hits']} misses {stats['misses']} evictions {stats['evictions']}"
+        )
@@ -0,0 +1,298 @@
+import struct
+import zlib
+
+import numpy as np
+
+from src.data_loading.spawn_table import (
+    DESCRIPTOR_DTYPE,
+    DescriptorList,
+    ImageNames,
+    SpawnTable,
+)
+
+# ---- v2 layout ----
+# header, then one table entry per section, then the sections, each starting
+# on an 8 byte boundary. Everything is little-endian.
+#
+#   header   magic, version, flags, section count, sha256 of the file it was
+#            converted from (the bake cache key, so converting does not
+#            throw away baked levels)
+#   entry    kind, flags, dimension (index for static items), offset,
+#            stored size, size after decompression
+#
+#   strings  count, count + 1 offsets into the utf-8 blob, blob
+#   meshes   count, (vertex count, triangle index count) per mesh, then per
+#            mesh its float32 vertices and int32 triangle indices
+#   spawns   zone count, (zone, first row, end row) per zone, row count,
+#            DESCRIPTOR_DTYPE rows, images index the string table
+#   statics  row count, DESCRIPTOR_DTYPE rows
+#
+# Normals and UVs are not stored, the renderer never reads them.
+
+MAGIC = b"GTLV"
+VERSION = 2
+HEADER = struct.Struct("<4sHHI32s")
+SECTION_ENTRY = struct.Struct("<HHiQQQ")
+COUNT = struct.Struct("<I")
+ALIGNMENT = 8
+
+SECTION_COMPRESSED = 1
+
+STRINGS = 0
+MESHES = 1
+STATIC_ITEMS = 2
+# same order as the v1 file
+SPAWN_KINDS = {
+    3: ("container_map", True),
+    4: ("small_pickups_map", True),
+    5: ("big_pickups_map", True),
+    6: ("overflow_containers", False),
+    7: ("overflow_small_pickups", False),
+    8: ("overflow_big_pickups", False),
+}
+
+MESH_ROW_DTYPE = np.dtype([("vertices", "<i4"), ("triangles", "<i4")])
+ZONE_ROW_DTYPE = np.dtype([("zone", "<i4"), ("start", "<i4"), ("stop", "<i4")])
+
+
+def is_v2(data):
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+# ---- writing ----
+
+def strings_section(names):
+    encoded = [name.encode("utf-8") for name in names]
+    offsets = np.zeros(len(encoded) + 1, dtype="<u4")
+    offsets[1:] = np.cumsum([len(name) for name in encoded])
+    return COUNT.pack(len(encoded)) + offsets.tobytes() + b"".join(encoded)
+
+
+def meshes_section(meshes):
+    rows = np.array(
+        [(len(mesh["vertices"]), mesh["triangles"].size) for mesh in meshes],
+        dtype=MESH_ROW_DTYPE,
+    )
+    parts = [COUNT.pack(len(meshes)), rows.tobytes()]
+    for mesh in meshes:
+        parts.append(np.ascontiguousarray(mesh["vertices"], dtype="<f4").tobytes())
+        parts.append(np.ascontiguousarray(mesh["triangles"], dtype="<i4").tobytes())
+    return b"".join(parts)
+
+
+def rows_bytes(rows):
+    return COUNT.pack(len(rows)) + np.ascontiguousarray(rows, dtype=DESCRIPTOR_DTYPE).tobytes()
+
+
+def spawns_section(table):
+    zones = np.array(
+        [(zone, start, stop) for zone, (start, stop) in table.zones.items()],
+        dtype=ZONE_ROW_DTYPE,
+    )
+    return COUNT.pack(len(zones)) + zones.tobytes() + rows_bytes(table.rows)
+
+
+def write_level(level, source_digest, compress=False):
+    """
+    A level from load_data_binary as a v2 file. `source_digest` is the
+    sha256 of the file it was read from.
+    """
+    names = None
+    sections = []
+
+    for dimension_id, meshes in level["meshes"].items():
+        sections.append((MESHES, dimension_id, meshes_section(meshes)))
+
+    for kind, (section, _keyed) in SPAWN_KINDS.items():
+        for dimension_id, table in level[section].items():
+            names = table.names
+            sections.append((kind, dimension_id, spawns_section(table)))
+
+    for index, statics in enumerate(level["static_items"]):
+        names = statics.names
+        sections.append((STATIC_ITEMS, index, rows_bytes(statics.rows)))
+
+    # one ImageNames per level file, every table refers to it
+    sections.insert(0, (STRINGS, 0, strings_section(names.names if names is not None else [])))
+
+    offset = HEADER.size + SECTION_ENTRY.size * len(sections)
+    entries = []
+    blobs = []
+    for kind, dimension_id, raw in sections:
+        padding = -offset % ALIGNMENT
+        stored = raw
+        flags = 0
+        if compress:
+            packed = zlib.compress(raw, 9)
+            if len(packed) < len(raw):
+                stored = packed
+                flags = SECTION_COMPRESSED
+
+        offset += padding
+        entries.append(SECTION_ENTRY.pack(kind, flags, dimension_id, offset, len(stored), len(raw)))
+        blobs.append(b"\0" * padding + stored)
+        offset += len(stored)
+
+    header = HEADER.pack(MAGIC, VERSION, 0, len(sections), source_digest)
+    return header + b"".join(entries) + b"".join(blobs)
+
+
+# ---- reading ----
+
+def read_sections(data):
+    """
+    (source hash, [(kind, flags, dimension, stored bytes, size)]) with the
+    sections in file order, the stored bytes are views of `data`.
+    """
+    if len(data) < HEADER.size:
+        raise EOFError("Unexpected EOF while reading level header")
+
+    magic, version, _flags, count, digest = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("not a v2 level file")
+    if version != VERSION:
+        raise ValueError(f"unsupported level file version {version}")
+    if HEADER.size + SECTION_ENTRY.size * count > len(data):
+        raise EOFError("Unexpected EOF while reading section table")
+
+    view = memoryview(data)
+    sections = []
+    for i in range(count):
+        kind, flags, dimension_id, offset, stored, size = SECTION_ENTRY.unpack_from(
+            data, HEADER.size + SECTION_ENTRY.size * i
+        )
+        if offset + stored > len(data):
+            raise EOFError(f"Unexpected EOF while reading section {kind}")
+
+        sections.append((kind, flags, dimension_id, view[offset:offset + stored], size))
+
+    return digest.hex(), sections
+
+
+def section_buffer(flags, stored, size):
+    if not flags & SECTION_COMPRESSED:
+        return stored
+
+    raw = zlib.decompress(stored)
+    if len(raw) != size:
+        raise ValueError("corrupt compressed section")
+    return raw
+
+
+def read_strings(buffer):
+    count = COUNT.unpack_from(buffer, 0)[0]
+    offsets = np.frombuffer(buffer, dtype="<u4", count=count + 1, offset=COUNT.size)
+    blob = bytes(buffer[COUNT.size + offsets.nbytes:])
+
+    names = ImageNames()
+    for start, stop in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        names.intern(blob[start:stop].decode("utf-8"))
+    return names
+
+
+def read_meshes(buffer):
+    count = COUNT.unpack_from(buffer, 0)[0]
+    rows = np.frombuffer(buffer, dtype=MESH_ROW_DTYPE, count=count, offset=COUNT.size)
+    offset = COUNT.size + rows.nbytes
+
+    meshes = []
+    for verts_len, tris_len in rows.tolist():
+        vertices = np.frombuffer(buffer, dtype="<f4", count=verts_len * 3, offset=offset).reshape(verts_len, 3)
+        offset += vertices.nbytes
+        triangles = np.frombuffer(buffer, dtype="<i4", count=tris_len, offset=offset)
+        offset += triangles.nbytes
+        if triangles.size % 3 == 0:
+            triangles = triangles.reshape(-1, 3)
+
+        meshes.append({"vertices": vertices, "triangles": triangles, "normals": None, "uvs": None})
+    return meshes
+
+
+def read_rows(buffer, offset, names):
+    count = COUNT.unpack_from(buffer, offset)[0]
+    rows = np.frombuffer(buffer, dtype=DESCRIPTOR_DTYPE, count=count, offset=offset + COUNT.size)
+
+    # rows are used as they are, a broken index would only fail when drawn
+    images = rows["image"]
+    if len(rows) and (images.min() < 0 or images.max() >= len(names)):
+        raise ValueError("spawn image outside of the string table")
+    return rows
+
+
+def read_spawns(buffer, keyed, names):
+    count = COUNT.unpack_from(buffer, 0)[0]
+    zones = np.frombuffer(buffer, dtype=ZONE_ROW_DTYPE, count=count, offset=COUNT.size)
+    rows = read_rows(buffer, COUNT.size + zones.nbytes, names)
+
+    if len(zones) and (
+        (zones["start"] < 0).any() or (zones["stop"] < zones["start"]).any() or zones["stop"].max() > len(rows)
+    ):
+        raise ValueError("spawn zone outside of its rows")
+
+    return SpawnTable(
+        rows,
+        names,
+        {zone: (start, stop) for zone, start, stop in zones.tolist()},
+        keyed,
+    )
+
+
+def level_loaders(data, decompressed=None):
+    """
+    Loaders for every section of a v2 file, shaped like the level dict:
+        source_hash, meshes {dimension_id: loader}, static_items [loader],
+        spawn sections {section: {dimension_id: loader}}
+    Nothing but the section table is read until a loader is called.
+    `decompressed(size)` is called for every compressed section a loader
+    reads, what it returns views that buffer and not `data`.
+    """
+    source_hash, sections = read_sections(data)
+
+    names_section = [entry for entry in sections if entry[0] == STRINGS]
+    if not names_section:
+        raise ValueError("level file has no string table")
+    _kind, flags, _dimension_id, stored, size = names_section[0]
+    names = read_strings(section_buffer(flags, stored, size))
+
+    def loader(read, flags, stored, size, *args):
+        def load():
+            buffer = section_buffer(flags, stored, size)
+            if decompressed is not None and buffer is not stored:
+                decompressed(size)
+            return read(buffer, *args)
+        return load
+
+    loaders = {"source_hash": source_hash, "meshes": {}, "static_items": []}
+    for section, _keyed in SPAWN_KINDS.values():
+        loaders[section] = {}
+
+    for kind, flags, dimension_id, stored, size in sections:
+        if kind == MESHES:
+            loaders["meshes"][dimension_id] = loader(read_meshes, flags, stored, size)
+        elif kind == STATIC_ITEMS:
+            loaders["static_items"].append(
+                loader(lambda buffer: DescriptorList(read_rows(buffer, 0, names), names), flags, stored, size)
+            )
+        elif kind in SPAWN_KINDS:
+            section, keyed = SPAWN_KINDS[kind]
+            loaders[section][dimension_id] = loader(read_spawns, flags, stored, size, keyed, names)
+
+    return loaders
+
+
+def load_v2_buffer(data):
+    """
+    Same dict as load_data_buffer for a v2 file, every section decoded.
+    """
+    loaders = level_loaders(data)
+    level = {
+        "meshes": {dimension_id: load() for dimension_id, load in loaders["meshes"].items()},
+    }
+    for section, keyed in SPAWN_KINDS.values():
+        if keyed:
+            level[section] = {dimension_id: load() for dimension_id, load in loaders[section].items()}
+    level["static_items"] = [load() for load in loaders["static_items"]]
+    for section, keyed in SPAWN_KINDS.values():
+        if not keyed:
+            level[section] = {dimension_id: load() for dimension_id, load in loaders[section].items()}
+    return level
@@ -0,0 +1,231 @@
+import sys
+import threading
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+# one row per ContainerDescriptor, the image is an index into ImageNames and
+# the key is the spawn id inside its zone (the row number for lists)
+DESCRIPTOR_DTYPE = np.dtype([
+    ("key", "<i4"),
+    ("x", "<f4"),
+    ("y", "<f4"),
+    ("rotation", "<i4"),
+    ("image", "<i4"),
+])
+
+
+class ImageNames:
+    """
+    Every image name of a level stored once, descriptor rows refer to them by
+    index. Shared by all tables of one level file.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.index = {}
+        # lazy sections of one level can be decoded from several threads
+        self.lock = threading.Lock()
+
+    def intern(self, name):
+        index = self.index.get(name)
+        if index is None:
+            with self.lock:
+                index = self.index.get(name)
+                if index is None:
+                    index = len(self.names)
+                    self.names.append(sys.intern(name))
+                    self.index[name] = index
+        return index
+
+    def __getitem__(self, index):
+        return self.names[index]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        return {"names": self.names}
+
+    def __setstate__(self, state):
+        self.names = [sys.intern(name) for name in state["names"]]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.lock = threading.Lock()
+
+
+def build_rows(columns):
+    """
+    Structured rows from the (keys, xs, ys, rotations, images) lists the
+    reader fills.
+    """
+    keys, xs, ys, rotations, images = columns
+
+    rows = np.empty(len(keys), dtype=DESCRIPTOR_DTYPE)
+    rows["key"] = keys
+    rows["x"] = xs
+    rows["y"] = ys
+    rows["rotation"] = rotations
+    rows["image"] = images
+    return rows
+
+
+def descriptor(row, names):
+    # same dict the reader used to build for every spawn
+    key, x, y, rotation, image = row
+    return {"image": names[image], "position": (x, y), "rotation": rotation}
+
+
+class DescriptorList(Sequence):
+    """
+    Read-only list of descriptors kept as rows, every item is turned into a
+    descriptor dict when it is accessed. Static items of a dimension and the
+    zones of an overflow list.
+    """
+
+    def __init__(self, rows, names):
+        self.rows = rows
+        self.names = names
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self.rows))[index]]
+        return descriptor(self.rows[index].tolist(), self.names)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        names = self.names
+        for row in self.rows.tolist():
+            yield descriptor(row, names)
+
+
+class KeyedDescriptors(Mapping):
+    """
+    One zone of a SpawnTable, spawn id -> descriptor dict.
+    """
+
+    def __init__(self, table, zone):
+        self.table = table
+        self.zone = zone
+
+    def __getitem__(self, key):
+        found = self.table.lookup(self.zone, key)
+        if found is None:
+            raise KeyError(key)
+        return found
+
+    def __iter__(self):
+        start, stop = self.table.zones[self.zone]
+        return iter(self.table.rows["key"][start:stop].tolist())
+
+    def __len__(self):
+        start, stop = self.table.zones[self.zone]
+        return stop - start
+
+    def items(self):
+        start, stop = self.table.zones[self.zone]
+        names = self.table.names
+        return [(row[0], descriptor(row, names)) for row in self.table.rows[start:stop].tolist()]
+
+    def values(self):
+        return [descriptor for _, descriptor in self.items()]
+
+
+class SpawnTable(Mapping):
+    """
+    Spawns of one dimension of a spawn map or overflow list as one block of
+    rows, zone by zone in file order. Reads like the nested dicts it replaces,
+    zone -> {id: descriptor} for spawn maps and zone -> [descriptor] for
+    overflows, lookup and at query it without building them.
+    """
+
+    def __init__(self, rows, names, zones, keyed):
+        self.rows = rows
+        self.names = names
+        # zone: (first row, end row)
+        self.zones = zones
+        self.keyed = keyed
+        self.index_keys = None
+        self.index_rows = None
+
+    def build_index(self):
+        # (zone, id) packed into one sorted int64 per row, searched instead
+        # of holding a dict entry per spawn
+        zone_of_row = np.full(len(self.rows), -1, dtype=np.int64)
+        for zone, (start, stop) in self.zones.items():
+            zone_of_row[start:stop] = zone
+
+        packed = (zone_of_row << 32) | (self.rows["key"].astype(np.int64) & 0xFFFFFFFF)
+        order = np.argsort(packed, kind="stable")
+        # keys last, they are what tells other threads the index is there
+        self.index_rows = order.astype(np.int32)
+        self.index_keys = packed[order]
+
+    def row(self, zone, key):
+        """
+        Row index of spawn `key` in `zone` or None, the last one wins like it
+        did in the dicts.
+        """
+        if zone not in self.zones:
+            return None
+        if self.index_keys is None:
+            self.build_index()
+
+        packed = (int(zone) << 32) | (int(key) & 0xFFFFFFFF)
+        position = int(np.searchsorted(self.index_keys, packed, side="right")) - 1
+        if position < 0 or self.index_keys[position] != packed:
+            return None
+        return int(self.index_rows[position])
+
+    def lookup(self, zone, key):
+        """
+        Descriptor of spawn `key` in `zone` of a spawn map or None.
+        """
+        row = self.row(zone, key)
+        if row is None:
+            return None
+        return descriptor(self.rows[row].tolist(), self.names)
+
+    def at(self, zone, index):
+        """
+        Descriptor number `index` of `zone` of an overflow list or None.
+        """
+        if zone not in self.zones:
+            return None
+        start, stop = self.zones[zone]
+        if not 0 <= index < stop - start:
+            return None
+        return descriptor(self.rows[start + index].tolist(), self.names)
+
+    def descriptors(self):
+        """
+        (zone, id, descriptor) of every spawn in file order.
+        """
+        names = self.names
+        for zone, (start, stop) in self.zones.items():
+            for row in self.rows[start:stop].tolist():
+                yield zone, row[0], descriptor(row, names)
+
+    def __getitem__(self, zone):
+        if zone not in self.zones:
+            raise KeyError(zone)
+        if self.keyed:
+            return KeyedDescriptors(self, zone)
+        start, stop = self.zones[zone]
+        return DescriptorList(self.rows[start:stop], self.names)
+
+    def __iter__(self):
+        return iter(self.zones)
+
+    def __len__(self):
+        return len(self.zones)
+
+    def to_plain(self):
+        """
+        The nested dicts and lists the reader used to return.
+        """
+        return {
+            zone: dict(self[zone].items()) if self.keyed else list(self[zone])
+            for zone in self.zones
+        }
@@ -1,14 +1,18 @@
 import ctypes
 import json
 import os
+import threading
+from collections import deque
 from ctypes import CFUNCTYPE, c_char_p, c_uint8, c_uint32, c_void_p
 from pathlib import Path
 
+from src import metrics
 from src.data_loading.item_name_convert import convert_name, reset_keys
-from src.data_loading.level import load_level
-from src.mesh_handling.load_mesh import get_bounds_svg_multi
-from src.mesh_handling.svg import add_item
-from src.page_generator.open_generated import open_generated_svg
+from src.data_loading.level import bake_dimensions, level_cache, load_level, prefetch_level
+from src.mesh_handling.svg import SvgDocument, add_item
+from src.page_generator import open_generated
+from src.page_generator.open_generated import open_generated_svg, publish_overlay
+from src.metrics import log
 from src.show_containers import add_text
 
 dll_relative_path = "../resources/gtfo_log_reader_core_64bit.dll"
@@ -46,17 +50,12 @@ lib.remove_callback.argtypes = [c_uint8, c_uint32]
 lib.remove_callback.restype = None
 
 
-tracked_container_spawns = []
-tracked_small_pickup_spawns = []
-tracked_big_pickup_spawns = []
-marker_set = 0
-level_name = ""
-
-
 automatic_render = False
+# resolve spawns as their events arrive and only send what changed
+incremental = False
+overlay = None
 show_key_names = True
 force_dimension_render = None
-counter_containers = {}
 
 
 def drop_first(word_string, n: int):
@@ -70,135 +69,394 @@ def get_data_from_arrs(map, overflow, counter_overflow, dimension, zone, id):
     
     if id == -1:
         in_list_id = counter_overflow.get(dimension, {}).get(zone, 0)
-        try:
-            data = overflow.get(dimension, {}).get(zone, [])[in_list_id]
-        except IndexError:
-            data = None
+        table = overflow.get(dimension)
+        if table is not None:
+            data = table.at(zone, in_list_id)
         
         counter_overflow.setdefault(dimension, {})[zone] = in_list_id + 1
         
-        print(f"{in_list_id}: {data}")
+        log.debug("overflow %s: %s", in_list_id, data)
     else:
-        data = map.get(dimension, {}).get(zone, {}).get(id, None)
+        table = map.get(dimension)
+        if table is not None:
+            data = table.lookup(zone, id)
     
     return data
 
 
-def do_everything():
-    global tracked_container_spawns, tracked_small_pickup_spawns, tracked_big_pickup_spawns
-    global marker_set, level_name, counter_containers
+# category of a tracked spawn: (spawn map, overflow list) in the level data
+SPAWN_SOURCES = {
+    "container": ("container_map", "overflow_containers"),
+    "small_pickup": ("small_pickups_map", "overflow_small_pickups"),
+    "big_pickup": ("big_pickups_map", "overflow_big_pickups"),
+}
+
+
+class GenerationState:
+    """
+    Everything the game reported about one generation. The callback thread
+    fills its own state while the generation runs and publishes a snapshot
+    of it when the generation ends, renders only read snapshots and never
+    see a list that is being cleared or added to.
+    """
+
+    def __init__(self, level_name="", marker=0, spawns=None):
+        self.level_name = level_name
+        self.marker = marker
+        # category: [(name, dimension, zone, id)] in the order they spawned,
+        # tuples in a snapshot
+        if spawns is None:
+            spawns = {category: [] for category in SPAWN_SOURCES}
+        self.spawns = spawns
+
+    def add(self, category, item_spawn):
+        self.spawns[category].append(item_spawn)
+
+    def tracked_spawns(self):
+        return list(self.spawns.items())
+
+    def snapshot(self):
+        return GenerationState(
+            self.level_name,
+            self.marker,
+            {category: tuple(spawns) for category, spawns in self.spawns.items()},
+        )
+
+
+# only touched by the callback thread
+generation = GenerationState()
+# last finished generation, replaced as a whole
+published = generation.snapshot()
+
+
+def publish_generation():
+    global published
+    published = generation.snapshot()
+    return published
+
+
+def place_spawn(svg, category, item_spawn, level_data, overflow_counters, container_offsets, bounds):
+    """
+    Resolves one tracked spawn against the level data and draws it onto `svg`.
+    `overflow_counters` and `container_offsets` carry the state between the
+    spawns of one generation.
+    """
+    old_name, dim_id, zone, id = item_spawn
+    name = convert_name(old_name)
+    spawn_map, overflow = SPAWN_SOURCES[category]
+
+    data = get_data_from_arrs(
+        level_data[spawn_map],
+        level_data[overflow],
+        overflow_counters.setdefault(category, {}),
+        dim_id,
+        zone,
+        id
+    )
+
+    if data is None:
+        return svg
+
+    if category == "container":
+        if name == "consumable":
+            name = drop_first(data["image"], 2)
+
+        offset = container_offsets.get(dim_id, {}).get(zone, {}).get(id, 0)
+
+        container_offsets.setdefault(dim_id, {}).setdefault(zone, {})[id] = offset + 1
+        pos_x, pos_y = data["position"]
+        pos_x += offset * 1.6
+        pos = (pos_x, pos_y)
+
+        svg = add_item(svg, name, pos, data["rotation"], bounds)
+
+        if name == "Key0":
+            pos_y += 10
+            svg = add_text(svg, (pos_x, pos_y), bounds, old_name, 1)
+
+        return svg
+
+    if category == "big_pickup":
+        log.debug("%s spawned in %s at %s", name, zone, id)
+
+    if name == "consumable":
+        name = drop_first(data["image"], 1)
+
+    return add_item(svg, name, data["position"], data["rotation"], bounds)
+
+
+class RenderWorker:
+    """
+    Runs renders on one thread so the DLL callback never waits for them.
+    Every task belongs to the generation that was current when it was
+    submitted, tasks of a generation a newer GenerationStart replaced are
+    dropped, and of several waiting full renders only the last one runs.
+    """
+
+    def __init__(self):
+        self.tasks = deque()
+        self.condition = threading.Condition()
+        self.generation = 0
+        # generation of the task that is running
+        self.running = None
+        self.thread = None
+
+    def start_generation(self):
+        with self.condition:
+            self.generation += 1
+            dropped = len(self.tasks)
+            self.tasks.clear()
+        if dropped:
+            metrics.count("render_tasks_dropped", dropped)
+
+    def submit(self, fn, *args, coalesce=False):
+        """
+        Queues fn(*args), with `coalesce` it replaces the full render that is
+        still waiting.
+        """
+        with self.condition:
+            if coalesce:
+                waiting = len(self.tasks)
+                self.tasks = deque(task for task in self.tasks if not task[3])
+                if len(self.tasks) < waiting:
+                    metrics.count("renders_coalesced")
+
+            self.tasks.append((self.generation, fn, args, coalesce))
+            self.condition.notify()
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="render", daemon=True)
+                self.thread.start()
+
+    def stale(self):
+        """
+        True on the worker while its task belongs to a replaced generation,
+        long renders check it and give up.
+        """
+        return threading.current_thread() is self.thread and self.running != self.generation
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.tasks:
+                    self.condition.wait()
+                generation, fn, args, _ = self.tasks.popleft()
+                if generation != self.generation:
+                    metrics.count("render_tasks_dropped")
+                    continue
+                self.running = generation
+
+            try:
+                fn(*args)
+            except Exception as e:
+                log.warning("render failed: %s", e)
+
+
+render_worker = RenderWorker()
+
+
+def request_render(state=None):
+    # an incremental generation keeps its own documents, a full render of the
+    # last finished generation would put the wrong map under its deltas
+    if overlay is not None:
+        render_worker.submit(overlay.republish)
+        return
+    render_worker.submit(do_everything, state, coalesce=True)
+
+
+def do_everything(state=None):
+    """
+    Renders every spawn of `state`, by default the last finished generation.
+    """
+    if state is None:
+        state = published
+    if not state.level_name:
+        # no generation finished yet
+        return
 
-    level_data = load_level(level_name, marker_set)
+    level_data = load_level(state.level_name, state.marker)
     if level_data is None:
         return
 
-    container_map = level_data["container_map"]
-    small_pickups_map = level_data["small_pickups_map"]
-    big_pickups_map = level_data["big_pickups_map"]
-    
-    overflow_containers = level_data["overflow_containers"]
-    overflow_small_pickups = level_data["overflow_small_pickups"]
-    overflow_big_pickups = level_data["overflow_big_pickups"]
-    
-    overflow_counter_container = {}
-    overflow_counter_small_pickup = {}
-    overflow_counter_big_pickup = {}
-    
-    counter_containers = {}
+    overflow_counters = {}
+    container_offsets = {}
+
+    dimensions = range(len(level_data["dimensions_svgs"]))
+    if force_dimension_render is not None:
+        dimensions = [force_dimension_render]
+    bake_dimensions(level_data, dimensions)
 
     for i in range(len(level_data["dimensions_svgs"])):
         if force_dimension_render is not None and force_dimension_render != i:
             continue
+
+        if render_worker.stale():
+            metrics.count("renders_abandoned")
+            log.debug("render of %s abandoned, a newer generation started", state.level_name)
+            return
         
-        svg = level_data["dimensions_svgs"][i][:]
-        bounds = get_bounds_svg_multi(level_data["meshes"][i])
-
-        for item_spawn in tracked_container_spawns:
-            old_name, dim_id, zone, id = item_spawn
-            if dim_id != i:
-                continue
-                
-            name = convert_name(old_name)
-
-            data = get_data_from_arrs(
-                container_map, 
-                overflow_containers, 
-                overflow_counter_container, 
-                i, 
-                zone, 
-                id
-            )
+        svg = SvgDocument(level_data["dimensions_svgs"][i], level_data["dimensions_lods"][i])
+        bounds = level_data["dimensions_bounds"][i]
+
+        with metrics.span("overlay"):
+            for category, spawns in state.tracked_spawns():
+                for item_spawn in spawns:
+                    if item_spawn[1] != i:
+                        continue
+
+                    svg = place_spawn(
+                        svg,
+                        category,
+                        item_spawn,
+                        level_data,
+                        overflow_counters,
+                        container_offsets,
+                        bounds
+                    )
 
-            if data is None:
-                continue
-            
-            if name == "consumable":
-                name = drop_first(data["image"], 2)
-
-            offset = counter_containers.get(i, {}).get(zone, {}).get(id, 0)
-
-            counter_containers.setdefault(i, {}).setdefault(zone, {})[id] = offset + 1
-            pos_x, pos_y = data["position"]
-            pos_x += offset * 1.6
-            pos = (pos_x, pos_y)
-
-            svg = add_item(svg, name, pos, data["rotation"], bounds)
-            
-            if name == "Key0":
-                pos_y += 10
-                svg = add_text(svg, (pos_x, pos_y), bounds, old_name, 1)
-            
-        for item_spawn in tracked_small_pickup_spawns:
-            name, dim_id, zone, id = item_spawn
-            if dim_id != i:
-                continue
-                
-            name = convert_name(name)
-
-            data = get_data_from_arrs(
-                small_pickups_map, 
-                overflow_small_pickups, 
-                overflow_counter_small_pickup, 
-                i, 
-                zone, 
-                id
+        open_generated_svg(svg, i)
+
+    log.info("render: %s | %s", metrics.summary_line(), level_cache.summary())
+
+
+class SpawnOverlay:
+    """
+    Spawns of one generation, resolved against the level as their events
+    arrive and drawn into one SvgDocument per dimension. Server viewers get
+    the whole map once and afterwards only the newly placed items.
+    """
+
+    def __init__(self):
+        self.level_data = None
+        # spawns that came before the level file was known
+        self.pending = []
+        self.documents = {}
+        # dimension: (defs, fragments) that were already sent
+        self.published = {}
+        self.overflow_counters = {}
+        self.container_offsets = {}
+
+    def dimensions(self):
+        count = len(self.level_data["dimensions_svgs"])
+        if force_dimension_render is not None:
+            return [force_dimension_render] if force_dimension_render < count else []
+        return list(range(count))
+
+    def document(self, dimension):
+        if dimension not in self.documents:
+            self.documents[dimension] = SvgDocument(
+                self.level_data["dimensions_svgs"][dimension],
+                self.level_data["dimensions_lods"][dimension],
             )
-                
-            if data is None:
-                continue
-                
-            if name == "consumable":
-                name = drop_first(data["image"], 1)
-
-            svg = add_item(svg, name, data["position"], data["rotation"], bounds)
-            
-        for item_spawn in tracked_big_pickup_spawns:
-            name, dim_id, zone, id = item_spawn
-            if dim_id != i:
-                continue
-                
-            name = convert_name(name)
-
-            data = get_data_from_arrs(
-                big_pickups_map, 
-                overflow_big_pickups, 
-                overflow_counter_big_pickup, 
-                i, 
-                zone, 
-                id
+        return self.documents[dimension]
+
+    def bind(self, level_data):
+        """
+        Sets the level once its file is known and places everything that
+        was waiting for it.
+        """
+        if self.level_data is not None or level_data is None:
+            return
+
+        self.level_data = level_data
+        bake_dimensions(level_data, self.dimensions())
+
+        pending, self.pending = self.pending, []
+        for category, item_spawn in pending:
+            self.place(category, item_spawn)
+
+        for dimension in self.dimensions():
+            self.publish(dimension)
+
+    def add(self, category, item_spawn):
+        if self.level_data is None:
+            self.pending.append((category, item_spawn))
+            return
+
+        dimension = self.place(category, item_spawn)
+        if dimension is not None:
+            self.publish(dimension)
+
+    def place(self, category, item_spawn):
+        dimension = item_spawn[1]
+        if dimension not in self.dimensions():
+            return None
+
+        with metrics.span("overlay"):
+            place_spawn(
+                self.document(dimension),
+                category,
+                item_spawn,
+                self.level_data,
+                self.overflow_counters,
+                self.container_offsets,
+                self.level_data["dimensions_bounds"][dimension],
             )
+        return dimension
+
+    def publish(self, dimension):
+        # files are only written once in finish
+        if not open_generated.use_html_server:
+            return
+
+        document = self.document(dimension)
+
+        if dimension not in self.published:
+            open_generated_svg(document, dimension)
+        else:
+            defs_sent, fragments_sent = self.published[dimension]
+            delta = "".join(document.fragments[fragments_sent:])
+            if len(document.defs) > defs_sent:
+                delta = "<defs>" + "".join(document.defs[defs_sent:]) + "</defs>" + delta
+            if delta:
+                publish_overlay(delta, dimension)
+
+        self.published[dimension] = (len(document.defs), len(document.fragments))
+
+    def republish(self):
+        """
+        Sends every document as a whole map again, the deltas after it go on
+        top of that.
+        """
+        if self.level_data is None:
+            return
+
+        self.published.clear()
+        for dimension in self.dimensions():
+            if open_generated.use_html_server:
+                self.publish(dimension)
+            else:
+                open_generated_svg(self.document(dimension), dimension)
 
-            if data is None:
-                continue
-                
-            print(f"{name} spawned in {zone} at {id}")
-            
-            if name == "consumable":
-                name = drop_first(data["image"], 1)
+    def finish(self, level_data):
+        self.bind(level_data)
+        if self.level_data is None:
+            return
 
-            svg = add_item(svg, name, data["position"], data["rotation"], bounds)
+        for dimension in self.dimensions():
+            if open_generated.use_html_server:
+                self.publish(dimension)
+            else:
+                open_generated_svg(self.document(dimension), dimension)
 
-        open_generated_svg(svg, i)
+        log.info("render: %s | %s", metrics.summary_line(), level_cache.summary())
+
+
+# the level is loaded on the render worker, the callback only queues these
+
+def bind_overlay(overlay, level_name, marker):
+    overlay.bind(load_level(level_name, marker))
+
+
+def finish_overlay(overlay, level_name, marker):
+    overlay.finish(load_level(level_name, marker))
+
+
+def prefetch_dimensions():
+    # None bakes every dimension
+    if force_dimension_render is not None:
+        return [force_dimension_render]
+    return None
 
 
 # 4. Implement a Python callback function
@@ -206,43 +464,54 @@ def do_everything():
 # u set when the callback is created by add_callback(...)
 @CALLBACK_TYPE
 def my_event_callback(_context, message):
-    global tracked_container_spawns, tracked_small_pickup_spawns, tracked_big_pickup_spawns
-    global marker_set, level_name, counter_containers
+    global generation, overlay
 
     if message:
         data = json.loads(message)
 
         if "GenerationStart" in data:
-            tracked_container_spawns.clear()
-            tracked_small_pickup_spawns.clear()
-            tracked_big_pickup_spawns.clear()
+            render_worker.start_generation()
             reset_keys()
-            counter_containers = {}
-            marker_set = 0
-            level_name = data["GenerationStart"]
+            # a new object, snapshots taken so far keep their lists
+            generation = GenerationState(data["GenerationStart"])
+            overlay = SpawnOverlay() if incremental and automatic_render else None
+            # load and bake while the game generates, only the spawns are left
+            # for GenerationEnd
+            prefetch_level(generation.level_name, dimensions=prefetch_dimensions())
 
         if "Key" in data:
             name, dim, zone, id = data["Key"]
             if name in {"ArtifactWorldspawn", "ConsumableWorldspawn"}:
-                tracked_small_pickup_spawns.append((name, dim, zone, id))
+                category = "small_pickup"
             elif name in {"Cell", "CELL", "RetrieveBigItems", "FOG_TURBINE", "DATA_SPHERE"}:
-                tracked_big_pickup_spawns.append((name, dim, zone, id))
+                category = "big_pickup"
             else:
-                tracked_container_spawns.append((name, dim, zone, id))
+                category = "container"
+
+            generation.add(category, (name, dim, zone, id))
+            if overlay is not None:
+                render_worker.submit(overlay.add, category, (name, dim, zone, id))
 
         if "ResourcePack" in data:
             name, dim, zone, id, _size = data["ResourcePack"]
-            tracked_container_spawns.append((name, dim, zone, id))
+            generation.add("container", (name, dim, zone, id))
+            if overlay is not None:
+                render_worker.submit(overlay.add, "container", (name, dim, zone, id))
 
         if "GenerationOverflowHash" in data:
             b = bytes(data["GenerationOverflowHash"])
             hex_string = b.hex()
-            marker_set = hex_string[-16:]
+            generation.marker = hex_string[-16:]
+            prefetch_level(generation.level_name, generation.marker, prefetch_dimensions())
+            if overlay is not None:
+                render_worker.submit(bind_overlay, overlay, generation.level_name, generation.marker)
 
         if "GenerationEnd" in data:
-            if automatic_render:
-                do_everything()
-            pass
+            state = publish_generation()
+            if overlay is not None:
+                render_worker.submit(finish_overlay, overlay, state.level_name, state.marker)
+            elif automatic_render:
+                request_render(state)
 
 
 def start_dll_thread():
@@ -5,14 +5,18 @@ from multiprocessing import Process
 import keyboard
 import uvicorn
 
+from html_server import server
 from html_server.server import app
-from src import dll_integration
-from src.dll_integration import do_everything, start_dll_thread
+from src import dll_integration, metrics
+from src.data_loading import bake_cache, level
+from src.dll_integration import request_render, start_dll_thread
+from src.mesh_handling import load_mesh
+from src.mesh_handling import svg as svg_module
 from src.page_generator import open_generated
 
 
 def on_hotkey():
-    do_everything()
+    request_render()
 
 
 def run_server(ip="127.0.0.1", port=8000):
@@ -34,20 +38,48 @@ def main():
     parser.add_argument("-s", "--use-server", default=False, action="store_true", help="Render stuff on a nicer looking html server")
     parser.add_argument("-p", "--port", default=8000, help="Port used by the server")
     parser.add_argument("--ip", default="127.0.0.1", help="IP used by the server")
+    parser.add_argument("--no-cache", action="store_true", default=False, help="Always bake maps from scratch instead of reusing the on-disk bake cache")
+    parser.add_argument("--item-symbols", action="store_true", default=False, help="write every item icon once and reference it, makes maps with many items a lot smaller")
+    parser.add_argument("--path-precision", type=int, default=None, help="round floor outlines to this many decimals and write them compactly, 2 is plenty")
+    parser.add_argument("--lod", action="store_true", default=False, help="also bake coarser floor outlines that the server shows while zoomed out (-s only)")
+    parser.add_argument("--tiles", action="store_true", default=False, help="the server page only loads the visible tiles of the map (-s only)")
+    parser.add_argument("--incremental", action="store_true", default=False, help="place every spawn as soon as the game reports it, the map is ready when generation ends (with -s)")
+    parser.add_argument("--svgz", action="store_true", default=False, help="write the maps as gzipped .svgz files")
+    parser.add_argument("--in-process", action="store_true", default=False, help="run the server in this process and hand maps to it directly instead of over http (-s only)")
+    parser.add_argument("--level-cache-mb", type=int, default=level.max_level_cache_bytes // (1024 * 1024), help="how many MB of loaded levels are kept in memory, the level being played is always kept")
+    parser.add_argument("--no-prefetch", action="store_true", default=False, help="do not load and bake the level in the background while the game generates it")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO", help="how much is logged, DEBUG shows every decoded mesh and spawn")
+    parser.add_argument("--bake-workers", type=int, default=level.bake_workers, help="how many processes bake the dimensions of a level, 1 bakes them one after the other")
 
     args = parser.parse_args()
+    metrics.configure_logging(args.log_level)
 
     open_generated.port = args.port
     open_generated.use_html_server = args.use_server
     open_generated.reopen = args.stop_automatic_reopen
+    open_generated.svgz = args.svgz
+    open_generated.tiles = args.tiles
+    open_generated.in_process = args.use_server and args.in_process
     if args.use_server:
         dll_integration.automatic_render = True
+    dll_integration.incremental = args.incremental
     if args.dimension_shown is not None:
         dll_integration.force_dimension_render = int(args.dimension_shown)
-
-    # Start FastAPI server in a separate process
+    if args.no_cache:
+        bake_cache.enabled = False
+    load_mesh.path_precision = args.path_precision
+    if args.item_symbols:
+        svg_module.item_mode = "symbol"
+    svg_module.lod = args.lod
+    level.bake_workers = args.bake_workers
+    level.level_cache.max_bytes = args.level_cache_mb * 1024 * 1024
+    level.prefetch_enabled = not args.no_prefetch
+
+    # Start FastAPI server in a separate process, or in a thread of this one
     server_process = None
-    if args.use_server:
+    if args.use_server and args.in_process:
+        server.serve_in_thread(args.ip, args.port)
+    elif args.use_server:
         server_process = Process(target=run_server, args=(args.ip, args.port))
         server_process.daemon = True
         server_process.start()
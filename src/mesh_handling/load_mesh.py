@@ -2,15 +2,27 @@ import struct
 from pathlib import Path
 
 import numpy as np
+import shapely
 from lxml import etree
-from shapely.geometry import Polygon, MultiPoint
+from shapely.geometry import MultiPoint
 from shapely.ops import unary_union
 
+from src import metrics
+from src.metrics import log
+
 SIDE_BUFFERS = 5
 
+# coarse outline tiers are simplified until they are off by at most this
+# many pixels at the screen width they are made for
+LOD_PIXEL_ERROR = 0.5
+
+# None writes floor outlines with every coordinate at full precision and
+# absolute commands, a number of decimals switches to compact_path_data
+path_precision = None
+
 
 def load_unity_mesh_binary(path):
-    print(Path(path).absolute())
+    log.debug("loading %s", Path(path).absolute())
 
     with open(path, "rb") as f:
         vertex_count, index_count = struct.unpack("ii", f.read(8))
@@ -80,6 +92,156 @@ def to_svg_pos(p, lower_x_bound, upper_y_bound):
     return (x, y)
 
 
+def to_svg_pos_array(pts, lower_x_bound, upper_y_bound):
+    """
+    Vectorized to_svg_pos over an (..., 2) array, same operation order so the
+    results are bit for bit identical.
+    """
+    out = np.empty(pts.shape, dtype=float)
+    out[..., 0] = SIDE_BUFFERS + pts[..., 0] - lower_x_bound
+    out[..., 1] = SIDE_BUFFERS + upper_y_bound - pts[..., 1]  # flip inside bounding box
+    return out
+
+
+def triangle_corners(vertices, triangles, lower_x_bound, upper_y_bound):
+    """
+    Projected svg positions of every triangle corner, shape (n, 3, 2).
+    """
+    pts_2d = vertices[:, [0, 2]].astype(float)
+    return to_svg_pos_array(pts_2d[triangles], lower_x_bound, upper_y_bound)
+
+
+def as_polygon_list(geometry):
+    if geometry.is_empty:
+        return []
+    if geometry.geom_type == "Polygon":
+        return [geometry]
+    return [g for g in geometry.geoms if g.geom_type == "Polygon" and not g.is_empty]
+
+
+def merge_triangles(corners):
+    """
+    Merges the (n, 3, 2) triangle corners into a list of polygons.
+    """
+    return as_polygon_list(unary_union(shapely.polygons(corners)))
+
+
+def full_path_data(poly):
+    cmds = []
+
+    # exterior boundary
+    ext = poly.exterior.coords
+    cmds.append(f"M {ext[0][0]},{ext[0][1]}")
+    cmds += [f"L {x},{y}" for x, y in ext[1:]]
+    cmds.append("Z")
+
+    # holes
+    for interior in poly.interiors:
+        ic = interior.coords
+        cmds.append(f"M {ic[0][0]},{ic[0][1]}")
+        cmds += [f"L {x},{y}" for x, y in ic[1:]]
+        cmds.append("Z")
+
+    return " ".join(cmds)
+
+
+def ring_neighbours(ring_ids):
+    """
+    Index of the previous and next point of every point, wrapping around
+    inside its ring. `ring_ids` must be sorted.
+    """
+    index = np.arange(len(ring_ids))
+    _, starts, counts = np.unique(ring_ids, return_index=True, return_counts=True)
+    start = np.repeat(starts, counts)
+    count = np.repeat(counts, counts)
+
+    previous = start + (index - start - 1) % count
+    following = start + (index - start + 1) % count
+    return previous, following
+
+
+def format_fixed(values, decimals):
+    """
+    Formats integer multiples of 10^-decimals without trailing zeros.
+    """
+    if decimals == 0:
+        return values.astype(str)
+
+    text = np.char.mod(f"%.{decimals}f", values / 10 ** decimals)
+    return np.char.rstrip(np.char.rstrip(text, "0"), ".")
+
+
+def compact_path_data(polys, decimals):
+    """
+    Path data for every polygon, built for all of them at once:
+    coordinates are rounded to `decimals`, repeated and collinear points are
+    dropped and every ring is written as one absolute moveto followed by
+    relative lineto deltas. Deltas are taken between the rounded integers
+    so the rounding error does not add up along a ring.
+    """
+    if len(polys) == 0:
+        return []
+
+    rings, poly_ids = shapely.get_rings(np.asarray(polys, dtype=object), return_index=True)
+    coords, ring_ids = shapely.get_coordinates(rings, return_index=True)
+
+    # the closing point repeats the first one
+    ring_ends = np.append(ring_ids[1:] != ring_ids[:-1], True)
+    keep = ~ring_ends
+    q = np.rint(coords[keep] * 10.0 ** decimals).astype(np.int64)
+    ring_ids = ring_ids[keep]
+
+    # repeated points first, so a corner is never mistaken for collinear
+    previous, _ = ring_neighbours(ring_ids)
+    keep = (q != q[previous]).any(axis=1)
+    q, ring_ids = q[keep], ring_ids[keep]
+
+    previous, following = ring_neighbours(ring_ids)
+    before = q - q[previous]
+    after = q[following] - q
+    keep = before[:, 0] * after[:, 1] != before[:, 1] * after[:, 0]
+    q, ring_ids = q[keep], ring_ids[keep]
+
+    # rings that collapsed to a line are dropped, together with the holes of
+    # a collapsed exterior
+    ring_numbers, counts = np.unique(ring_ids, return_counts=True)
+    valid_rings = np.zeros(len(rings), dtype=bool)
+    valid_rings[ring_numbers[counts >= 3]] = True
+    is_exterior = np.append(True, poly_ids[1:] != poly_ids[:-1])
+    valid_polys = np.zeros(len(polys), dtype=bool)
+    valid_polys[poly_ids[is_exterior & valid_rings]] = True
+    valid_rings &= valid_polys[poly_ids]
+
+    keep = valid_rings[ring_ids]
+    q, ring_ids = q[keep], ring_ids[keep]
+
+    starts = np.append(True, ring_ids[1:] != ring_ids[:-1])
+    deltas = q.copy()
+    deltas[~starts] = q[1:][~starts[1:]] - q[:-1][~starts[1:]]
+
+    text = format_fixed(deltas.ravel(), decimals).reshape(-1, 2)
+    pairs = np.char.add(np.char.add(text[:, 0], " "), text[:, 1]).tolist()
+
+    boundaries = np.flatnonzero(starts).tolist() + [len(pairs)]
+    commands = {}
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        ring = f"M{pairs[start]}l{' '.join(pairs[start + 1:end])}z"
+        commands.setdefault(int(poly_ids[ring_ids[start]]), []).append(ring)
+
+    # a minus sign already separates two numbers
+    return [" ".join(commands[i]).replace(" -", "-") for i in sorted(commands)]
+
+
+def floor_path_data(polys):
+    """
+    Path data for the merged floor polygons with the selected path_precision.
+    """
+    if path_precision is None:
+        return [full_path_data(poly) for poly in polys]
+
+    return compact_path_data(polys, path_precision)
+
+
 def mesh_to_svg_edges(vertices, triangles, svg_size=(1000,1000), margin=10, stroke_width=0.8):
     """
     Generate SVG wireframe (edges only) from a triangle mesh.
@@ -134,22 +296,11 @@ def mesh_to_merged_svg(vertices, triangles):
     width = max_xy[0] - min_xy[0]
     height = max_xy[1] - min_xy[1]
 
-    # ---- Collect triangles as shapely polygons ----
-    polys = []
-    for a, b, c in triangles:
-        pa = to_svg_pos(pts_2d[a], min_xy[0], max_xy[1])
-        pb = to_svg_pos(pts_2d[b], min_xy[0], max_xy[1])
-        pc = to_svg_pos(pts_2d[c], min_xy[0], max_xy[1])
-        polys.append(Polygon([pa, pb, pc]))
+    # ---- Collect triangle corners ----
+    corners = triangle_corners(vertices, triangles, min_xy[0], max_xy[1])
 
     # ---- Merge all triangles ----
-    merged = unary_union(polys)
-
-    # ---- Normalize to list of polygons ----
-    if merged.geom_type == "Polygon":
-        merged_polys = [merged]
-    else:
-        merged_polys = list(merged.geoms)
+    merged_polys = merge_triangles(corners)
 
     # ---- Build SVG ----
     NSMAP = {None: "http://www.w3.org/2000/svg"}
@@ -160,30 +311,16 @@ def mesh_to_merged_svg(vertices, triangles):
         overflow="visible",
     )
 
-    for poly in merged_polys:
-        # exterior
-        ext = poly.exterior.coords
-        cmds = [f"M {x},{y}" for x, y in [ext[0]]]
-        cmds += [f"L {x},{y}" for x, y in ext[1:]]
-        cmds.append("Z")
-
-        # holes
-        for interior in poly.interiors:
-            coords = interior.coords
-            cmds.append(f"M {coords[0][0]},{coords[0][1]}")
-            cmds += [f"L {x},{y}" for x, y in coords[1:]]
-            cmds.append("Z")
-
-        d = " ".join(cmds)
+    for d in floor_path_data(merged_polys):
         etree.SubElement(root, "path", d=d, fill="rgb(47,61,68)")
 
-    return etree.tostring(root, pretty_print=True).decode("utf-8")
+    return etree.tostring(root, pretty_print=path_precision is None).decode("utf-8")
 
 
-def meshes_to_merged_svg(mesh_list):
+def merge_meshes(mesh_list):
     """
-    Convert multiple triangle meshes to a single merged SVG.
-    mesh_list is a list of (vertices, triangles)
+    Merges the floor of multiple triangle meshes.
+    Returns (merged polygons, width, height) in svg coordinates.
     """
 
     # ---------------------------------------------
@@ -205,34 +342,19 @@ def meshes_to_merged_svg(mesh_list):
     # ---------------------------------------------
     # 2. Build all polygons from all meshes
     # ---------------------------------------------
-    polys = []
-    for mesh in mesh_list:
-        vertices = mesh["vertices"]
-        triangles = mesh["triangles"]
-
-        pts_2d = vertices[:, [0, 2]].astype(float)
-
-        for a, b, c in triangles:
-            pa = to_svg_pos(pts_2d[a], min_xy[0], max_xy[1])
-            pb = to_svg_pos(pts_2d[b], min_xy[0], max_xy[1])
-            pc = to_svg_pos(pts_2d[c], min_xy[0], max_xy[1])
-
-            polys.append(Polygon([pa, pb, pc]))
+    corners = np.concatenate([
+        triangle_corners(mesh["vertices"], mesh["triangles"], min_xy[0], max_xy[1])
+        for mesh in mesh_list
+    ])
 
     # ---------------------------------------------
     # 3. Merge all triangles from all meshes
     # ---------------------------------------------
-    merged = unary_union(polys)
+    with metrics.span("union"):
+        return merge_triangles(corners), width, height
 
-    # Ensure output is iterable
-    if merged.geom_type == "Polygon":
-        merged_polys = [merged]
-    else:
-        merged_polys = list(merged.geoms)
 
-    # ---------------------------------------------
-    # 4. Build SVG
-    # ---------------------------------------------
+def polygons_to_svg(merged_polys, width, height):
     NSMAP = {None: "http://www.w3.org/2000/svg"}
     root = etree.Element(
         "svg",
@@ -241,22 +363,42 @@ def meshes_to_merged_svg(mesh_list):
         overflow="visible",
     )
 
-    for poly in merged_polys:
-        cmds = []
+    with metrics.span("serialize"):
+        for d in floor_path_data(merged_polys):
+            etree.SubElement(root, "path", d=d, fill="rgb(47,61,68)")
 
-        # exterior boundary
-        ext = poly.exterior.coords
-        cmds.append(f"M {ext[0][0]},{ext[0][1]}")
-        cmds += [f"L {x},{y}" for x, y in ext[1:]]
-        cmds.append("Z")
+        return etree.tostring(root, pretty_print=path_precision is None).decode("utf-8")
 
-        # holes
-        for interior in poly.interiors:
-            ic = interior.coords
-            cmds.append(f"M {ic[0][0]},{ic[0][1]}")
-            cmds += [f"L {x},{y}" for x, y in ic[1:]]
-            cmds.append("Z")
 
-        etree.SubElement(root, "path", d=" ".join(cmds), fill="rgb(47,61,68)")
+def meshes_to_merged_svg(mesh_list):
+    """
+    Convert multiple triangle meshes to a single merged SVG.
+    mesh_list is a list of (vertices, triangles)
+    """
+    merged_polys, width, height = merge_meshes(mesh_list)
+    return polygons_to_svg(merged_polys, width, height)
+
+
+def lod_tolerance(width, screen_width):
+    """
+    Simplification tolerance, in svg units, that stays below
+    LOD_PIXEL_ERROR when the whole map is drawn `screen_width` pixels wide.
+    """
+    return LOD_PIXEL_ERROR * (width + SIDE_BUFFERS * 2) / screen_width
+
+
+def meshes_to_lod_svgs(mesh_list, screen_widths):
+    """
+    The merged SVG followed by one simplified tier per entry of
+    `screen_widths`, the floor is only merged once.
+    """
+    merged_polys, width, height = merge_meshes(mesh_list)
+    svgs = [polygons_to_svg(merged_polys, width, height)]
+
+    polys = np.asarray(merged_polys, dtype=object)
+    for screen_width in screen_widths:
+        simplified = shapely.simplify(polys, lod_tolerance(width, screen_width), preserve_topology=True)
+        simplified = [poly for poly in simplified.tolist() if not poly.is_empty]
+        svgs.append(polygons_to_svg(simplified, width, height))
 
-    return etree.tostring(root, pretty_print=True).decode("utf-8")
\ No newline at end of file
+    return svgs
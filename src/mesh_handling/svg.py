@@ -1,14 +1,122 @@
 import xml.etree.ElementTree as ET
 
 from src.data_loading.item import load_item_svg
+from src.mesh_handling import load_mesh
 from src.mesh_handling.background import apply_grid_background
-from src.mesh_handling.load_mesh import get_bounds_svg_multi, meshes_to_merged_svg, to_svg_pos
+from src.mesh_handling.load_mesh import get_bounds_svg_multi, meshes_to_lod_svgs, meshes_to_merged_svg, to_svg_pos
+from src import metrics
+from src.metrics import log
 import re
 
 
+# bump whenever the baked svg output changes, invalidates the bake cache
+RENDERER_VERSION = 1
+
+# "inline": every placed item carries a full copy of its icon
+# "symbol": every used icon is written once into <defs> and placed with <use>
+ITEM_MODES = ["inline", "symbol"]
+item_mode = "inline"
+
+# with lod every bake also makes coarser floor outlines that the html viewer
+# shows while zoomed out, one tier for the whole map being drawn this many
+# pixels wide
+LOD_SCREEN_WIDTHS = [400, 1200]
+lod = False
+
+SYMBOL_ID = re.compile(r'<symbol id="([^"]+)"')
+
 item_svg_buffer = {}
 
 
+def render_settings():
+    """
+    Every setting that changes the baked svg, so it can be handed to bake
+    processes and be part of the bake cache key.
+    """
+    return {
+        "item_mode": item_mode,
+        "path_precision": load_mesh.path_precision,
+        "lod": lod,
+    }
+
+
+def apply_render_settings(settings):
+    global item_mode, lod
+
+    load_mesh.path_precision = settings["path_precision"]
+    item_mode = settings["item_mode"]
+    lod = settings["lod"]
+
+
+def item_symbol_id(item_name):
+    return "item-" + re.sub(r"[^A-Za-z0-9_-]", "_", item_name)
+
+
+class SvgDocument:
+    """
+    A baked svg plus the overlay fragments drawn on top of it. Fragments are
+    collected in a list and the document is only joined once, instead of
+    copying the whole svg for every added item.
+    """
+
+    def __init__(self, base, lods=()):
+        # everything is inserted right before the closing tag, like
+        # svg.replace("</svg>", fragment + "</svg>") did
+        end = base.rfind("</svg>")
+        if end == -1:
+            end = len(base)
+
+        self.head = base[:end]
+        self.tail = base[end:]
+        self.fragments = []
+        # coarser bases of the same map, they share every fragment
+        self.lod_heads = [lod_base[:lod_base.rfind("</svg>")] for lod_base in lods]
+        # symbols that a baked base already defines are reused
+        self.symbols = set(SYMBOL_ID.findall(self.head))
+        self.defs = []
+
+    def append(self, fragment):
+        self.fragments.append(fragment)
+
+    def add_symbol(self, symbol_id, markup):
+        if symbol_id in self.symbols:
+            return
+
+        self.symbols.add(symbol_id)
+        self.defs.append(f'<symbol id="{symbol_id}" overflow="visible">{markup}</symbol>')
+
+    def chunks(self, lod=None):
+        yield self.head if lod is None else self.lod_heads[lod]
+        if self.defs:
+            yield "<defs>" + "".join(self.defs) + "</defs>"
+        yield from self.fragments
+        yield self.tail
+
+    def write(self, f):
+        """
+        Streams the document into a text file object.
+        """
+        for chunk in self.chunks():
+            f.write(chunk)
+
+    def render(self, lod=None):
+        return "".join(self.chunks(lod))
+
+    def __str__(self):
+        return self.render()
+
+
+def append_fragment(svg, fragment):
+    """
+    Adds a fragment at the end of an SvgDocument or of a plain svg string.
+    """
+    if isinstance(svg, SvgDocument):
+        svg.append(fragment)
+        return svg
+
+    return svg.replace("</svg>", fragment + "</svg>")
+
+
 def extract_scale(path_svg):
     match = re.search(r'transform="[^"]*scale\(([^,]+),\s*([^)]+)\)"', path_svg)
     if not match:
@@ -64,12 +172,36 @@ def extract_inner_svg(svg_text: str) -> str:
     return "".join(inner_parts)
 
 
+def decorate_svg(svg, item_descriptors, bounds):
+    with metrics.span("serialize"):
+        svg = apply_grid_background(svg)
+
+        document = SvgDocument(svg)
+        add_static_items(document, item_descriptors, bounds)
+        return document.render()
+
+
 def get_svg(meshes, item_descriptors):
     bounds = get_bounds_svg_multi(meshes)
 
     svg = meshes_to_merged_svg(meshes)
-    svg = apply_grid_background(svg)
-    return add_static_items(svg, item_descriptors, bounds)
+    return decorate_svg(svg, item_descriptors, bounds)
+
+
+def get_svgs(meshes, item_descriptors):
+    """
+    The baked svg and its list of coarser lod tiers, empty unless lod is on.
+    """
+    if not lod:
+        return get_svg(meshes, item_descriptors), []
+
+    bounds = get_bounds_svg_multi(meshes)
+
+    svgs = [
+        decorate_svg(svg, item_descriptors, bounds)
+        for svg in meshes_to_lod_svgs(meshes, LOD_SCREEN_WIDTHS)
+    ]
+    return svgs[0], svgs[1:]
     
 
 def add_item(svg, item_name, pos, rotation, bounds):
@@ -85,24 +217,29 @@ def add_item(svg, item_name, pos, rotation, bounds):
             return svg
 
         pos_x, pos_y = to_svg_pos([pos_x, pos_y], bounds[0][0], bounds[1][1])
-        
+
+        if item_mode == "symbol" and isinstance(svg, SvgDocument):
+            symbol_id = item_symbol_id(item_name)
+            svg.add_symbol(symbol_id, item_svg_buffer[item_name])
+            svg.append(f'<use href="#{symbol_id}" transform="translate({pos_x}, {pos_y}) rotate({rotation})"/>')
+            return svg
+
         group = f"""
         <g transform="translate({pos_x}, {pos_y}) rotate({rotation})">
             {item_svg_buffer[item_name]}
         </g>
         """
 
-        svg = svg.replace("</svg>", group + "</svg>")
+        svg = append_fragment(svg, group)
     except Exception as e:
         item_svg_buffer[item_name] = None
-        print(e)
+        log.warning("could not add item %s: %s", item_name, e)
 
     return svg
 
 
 def add_static_items(svg, item_descriptors, bounds):
     for item in item_descriptors:
-        print(item["position"])
         svg = add_item(svg, item["image"], item["position"], item["rotation"], bounds)
 
     return svg
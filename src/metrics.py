@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# every module logs through this instead of printing, --log-level picks
+# what is shown
+log = logging.getLogger("live_gtfo")
+
+# stages between the game ending a generation and the map showing up
+STAGES = ["deserialize", "bake", "union", "overlay", "serialize", "publish"]
+# upper bounds of the histogram buckets in seconds
+BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+
+lock = threading.Lock()
+counters = {}
+gauges = {}
+histograms = {}
+# {name: [count, seconds]} since the last summary_line
+recent = {}
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+
+def configure_logging(level="INFO"):
+    logging.basicConfig(format="[%(levelname)s] %(message)s", level=level.upper())
+
+
+def count(name, amount=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def gauge(name, value):
+    with lock:
+        gauges[name] = value
+
+
+def observe(name, seconds):
+    with lock:
+        histograms.setdefault(name, Histogram()).observe(seconds)
+        entry = recent.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+
+@contextmanager
+def span(name):
+    """
+    Times the block into the histogram `name`, also when it raises.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+# ---- moving metrics between processes ----
+
+def export():
+    """
+    Everything recorded in this process as plain data, see merge.
+    """
+    with lock:
+        return {
+            "counters": dict(counters),
+            "spans": [(name, seconds) for name, (_, seconds) in recent.items()],
+        }
+
+
+def reset():
+    with lock:
+        counters.clear()
+        gauges.clear()
+        histograms.clear()
+        recent.clear()
+
+
+def merge(exported):
+    """
+    Adds what a bake process recorded, every span counts as one observation.
+    """
+    for name, amount in exported.get("counters", {}).items():
+        count(name, amount)
+    for name, seconds in exported.get("spans", []):
+        observe(name, seconds)
+
+
+# ---- output ----
+
+def summary_line():
+    """
+    One line with the time spent per stage since the previous call.
+    """
+    with lock:
+        taken = dict(recent)
+        recent.clear()
+
+    names = [name for name in STAGES if name in taken]
+    names += sorted(name for name in taken if name not in STAGES)
+
+    parts = []
+    for name in names:
+        calls, seconds = taken[name]
+        parts.append(f"{name} {seconds * 1000:.0f}ms" + (f" x{calls}" if calls > 1 else ""))
+    return " | ".join(parts) if parts else "nothing timed"
+
+
+def prometheus_text():
+    """
+    Counters and histograms in the prometheus text format.
+    """
+    lines = []
+    with lock:
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE live_gtfo_{name}_total counter")
+            lines.append(f"live_gtfo_{name}_total {value}")
+
+        for name, value in sorted(gauges.items()):
+            lines.append(f"# TYPE live_gtfo_{name} gauge")
+            lines.append(f"live_gtfo_{name} {value}")
+
+        for name, histogram in sorted(histograms.items()):
+            metric = f"live_gtfo_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, amount in zip(BUCKETS, histogram.buckets):
+                cumulative += amount
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f"{metric}_sum {histogram.total:.6f}")
+            lines.append(f"{metric}_count {histogram.count}")
+
+    return "\n".join(lines) + "\n"
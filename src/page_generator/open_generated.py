@@ -1,30 +1,104 @@
+import gzip
 import tempfile
 import webbrowser
 from pathlib import Path
 import time
 import requests
 
+from html_server import server
+from src import metrics
+from src.mesh_handling.svg import LOD_SCREEN_WIDTHS
+
 use_html_server = False
 reopen = True
+# write .svgz instead of .svg in file mode
+svgz = False
+# open the tiled viewer of the html server
+tiles = False
+# the server runs in a thread of this process, maps are handed to it
+# directly instead of posted
+in_process = False
 ip = "127.0.0.1"
 port = 8000
+# one connection for every post
+session = requests.Session()
 
 BASE_DIR = Path(tempfile.gettempdir()) / "live_gtfo_svgs"
 BASE_DIR.mkdir(exist_ok=True)
 id_set = set()
 
-def open_generated_svg(svg: str, id):
+def open_generated_svg(svg, id):
+    """
+    `svg` is either a string or an SvgDocument, documents are streamed
+    chunk by chunk instead of being joined first.
+    """
+    metrics.count("maps_published")
+    with metrics.span("publish"):
+        send_svg(svg, id)
+
+def send_svg(svg, id):
     if use_html_server:
         if id not in id_set:
             id_set.add(id)
-            webbrowser.open(f"http://{ip}:{port}/?id={id}")
-        requests.post(f"http://{ip}:{port}/svg/{id}", data=svg)
+            webbrowser.open(f"http://{ip}:{port}/?id={id}" + ("&tiles=1" if tiles else ""))
+        if in_process:
+            hand_over_svg(svg, id)
+            return
+        if isinstance(svg, str):
+            session.post(f"http://{ip}:{port}/svg/{id}", data=svg.encode("utf-8"))
+            return
+
+        # coarse tiers first, the full map is what tells the viewers to reload
+        for lod, screen_width in enumerate(LOD_SCREEN_WIDTHS[:len(svg.lod_heads)]):
+            session.post(
+                f"http://{ip}:{port}/svg/{id}",
+                params={"lod": lod, "width": screen_width},
+                data=(chunk.encode("utf-8") for chunk in svg.chunks(lod)),
+            )
+        session.post(f"http://{ip}:{port}/svg/{id}", data=(chunk.encode("utf-8") for chunk in svg.chunks()))
         return
         
-    svg_path = BASE_DIR / f"live_{id}.svg"
-    svg_path.write_text(svg, encoding="utf-8")
+    if svgz:
+        svg_path = BASE_DIR / f"live_{id}.svgz"
+        f = gzip.open(svg_path, "wt", encoding="utf-8", compresslevel=6)
+    else:
+        svg_path = BASE_DIR / f"live_{id}.svg"
+        f = svg_path.open("w", encoding="utf-8")
+
+    with f:
+        if isinstance(svg, str):
+            f.write(svg)
+        else:
+            svg.write(f)
 
     url = f"file://{svg_path}?t={time.time()}"
     if reopen or id not in id_set:
         id_set.add(id)
-        webbrowser.open(url)
\ No newline at end of file
+        webbrowser.open(url)
+
+def hand_over_svg(svg, id):
+    # encoded and gzipped on this thread, the server loop only swaps it in
+    encoded = server.EncodedSvg(str(svg).encode("utf-8"))
+    encoded.gzipped()
+
+    lods = []
+    if not isinstance(svg, str):
+        for lod, screen_width in enumerate(LOD_SCREEN_WIDTHS[:len(svg.lod_heads)]):
+            lods.append((screen_width, server.EncodedSvg(svg.render(lod).encode("utf-8"))))
+
+    # ids arrive as strings over http
+    server.call_in_server(server.publish_svg, str(id), encoded, lods)
+
+def publish_overlay(fragment: str, id):
+    """
+    Sends svg fragments that are appended to the map the server already has.
+    """
+    if not use_html_server:
+        return
+
+    metrics.count("overlays_published")
+    with metrics.span("publish"):
+        if in_process:
+            server.call_in_server(server.publish_overlay, str(id), fragment.encode("utf-8"))
+            return
+        session.post(f"http://{ip}:{port}/svg/{id}/overlay", data=fragment.encode("utf-8"))
@@ -0,0 +1,101 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.data_loading import bake_cache, level
+from src.data_loading.level import build_loaded_extra_data
+from src.data_loading.lazy_level import load_lazy_level
+from src.mesh_handling import load_mesh, svg
+
+
+def prebake_level(path, settings):
+    """
+    Bakes every dimension of one level file into the bake cache.
+    Returns (dimensions, dimensions that were already cached, svg bytes).
+    """
+    svg.apply_render_settings(settings)
+
+    loaded = load_lazy_level(path)
+    if loaded is None:
+        raise ValueError(f"could not load {path}")
+
+    dimension_ids = list(loaded["meshes"].keys())
+    cached = sum(
+        bake_cache.cache_path(loaded["source_hash"], dim_id).exists()
+        for dim_id in dimension_ids
+    )
+
+    baked = build_loaded_extra_data(loaded)
+    size = sum(len(baked[i]["svg"].encode("utf-8")) for i in range(len(baked)))
+
+    return len(dimension_ids), cached, size
+
+
+def timed_prebake(path, settings):
+    start = time.perf_counter()
+    dimensions, cached, size = prebake_level(path, settings)
+    return dimensions, cached, size, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bakes every level into the on-disk bake cache")
+    parser.add_argument("levels", nargs="*", help="only bake these level files, e.g. R1A1_0.bin")
+    parser.add_argument("-f", "--folder", default="resources/levels", help="folder with the level files")
+    parser.add_argument("-w", "--workers", type=int, default=level.bake_workers, help="how many levels are baked at the same time")
+    parser.add_argument("--item-symbols", action="store_true", default=False, help="fill the cache for --item-symbols renders")
+    parser.add_argument("--path-precision", type=int, default=None, help="round floor outlines to this many decimals and write them compactly, 2 is plenty")
+    parser.add_argument("--lod", action="store_true", default=False, help="fill the cache for --lod renders")
+
+    args = parser.parse_args()
+
+    load_mesh.path_precision = args.path_precision
+    if args.item_symbols:
+        svg.item_mode = "symbol"
+    svg.lod = args.lod
+    settings = svg.render_settings()
+
+    filenames = args.levels or sorted(
+        filename for filename in os.listdir(args.folder) if filename.endswith(".bin")
+    )
+    paths = [os.path.join(args.folder, filename) for filename in filenames]
+
+    print(f"{'level':<32} {'dims':>4} {'cached':>6} {'seconds':>8} {'size':>10}")
+
+    start = time.perf_counter()
+    total_size = 0
+    failed = []
+
+    def report(path, result):
+        nonlocal total_size
+        dimensions, cached, size, seconds = result
+        total_size += size
+        print(f"{os.path.basename(path):<32} {dimensions:>4} {cached:>6} {seconds:>8.2f} {size / 1024:>8.0f}KB")
+
+    if args.workers <= 1:
+        for path in paths:
+            try:
+                report(path, timed_prebake(path, settings))
+            except Exception as e:
+                print(f"{os.path.basename(path):<32} failed: {e}")
+                failed.append(path)
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = {pool.submit(timed_prebake, path, settings): path for path in paths}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    report(path, future.result())
+                except Exception as e:
+                    print(f"{os.path.basename(path):<32} failed: {e}")
+                    failed.append(path)
+
+    print(f"baked {len(paths) - len(failed)} levels in {time.perf_counter() - start:.1f}s, {total_size / 1024 / 1024:.1f}MB of svg")
+    print(f"cache: {bake_cache.CACHE_DIR}")
+
+    if failed:
+        print(f"{len(failed)} levels failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
 import argparse
 import os
 
+from src import metrics
+from src.data_loading import bake_cache, level
 from src.data_loading.item import load_item_svg
-from src.data_loading.level import load_level
-from src.mesh_handling.load_mesh import get_bounds_svg_multi, to_svg_pos
-from src.mesh_handling.svg import add_item, extract_inner_svg
+from src.data_loading.level import bake_dimensions, load_level
+from src.mesh_handling import load_mesh
+from src.mesh_handling import svg as svg_module
+from src.mesh_handling.load_mesh import to_svg_pos
+from src.mesh_handling.svg import SvgDocument, add_item, append_fragment, extract_inner_svg
+from src.page_generator import open_generated
 from src.page_generator.open_generated import open_generated_svg
 
 
@@ -63,13 +68,23 @@ def add_text(svg, pos, bounds, text, text_size):
         </g>
         """
 
-        svg = svg.replace("</svg>", group + "</svg>")
+        svg = append_fragment(svg, group)
     except Exception as e:
         print(f"got error: {e}")
 
     return svg
 
 
+def dimension_spawns(spawn_map, dimension):
+    """
+    (zone, id, descriptor) of every spawn of a dimension in a spawn map.
+    """
+    table = spawn_map.get(dimension)
+    if table is None:
+        return []
+    return table.descriptors()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("level_name")
@@ -80,8 +95,15 @@ def main():
     parser.add_argument("-b", "--big-pickup-show", action="store_true", default=False, help="show big pickups")
     parser.add_argument("-t", "--text-size", type=float, nargs="?", default=1, help="change the text size")
     parser.add_argument("-i", "--hide-images", action="store_true", default=False, help="Hide images and just put the text where the container is")
+    parser.add_argument("--no-cache", action="store_true", default=False, help="Always bake the map from scratch instead of reusing the on-disk bake cache")
+    parser.add_argument("--item-symbols", action="store_true", default=False, help="write every item icon once and reference it, makes maps with many items a lot smaller")
+    parser.add_argument("--path-precision", type=int, default=None, help="round floor outlines to this many decimals and write them compactly, 2 is plenty")
+    parser.add_argument("--svgz", action="store_true", default=False, help="write the maps as gzipped .svgz files")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO", help="how much is logged, DEBUG shows every decoded mesh and spawn")
+    parser.add_argument("--bake-workers", type=int, default=level.bake_workers, help="how many processes bake the dimensions of a level, 1 bakes them one after the other")
 
     args = parser.parse_args()
+    metrics.configure_logging(args.log_level)
     
     level_name = args.level_name.upper()
     marker = args.marker
@@ -91,6 +113,13 @@ def main():
     show_big_pickups = args.big_pickup_show
     text_size = args.text_size
     hide_images = args.hide_images
+    if args.no_cache:
+        bake_cache.enabled = False
+    load_mesh.path_precision = args.path_precision
+    open_generated.svgz = args.svgz
+    if args.item_symbols:
+        svg_module.item_mode = "symbol"
+    level.bake_workers = args.bake_workers
 
     level_data = load_level(level_name, marker)
     if level_data is None:
@@ -106,51 +135,52 @@ def main():
     small_pickups_map = level_data["small_pickups_map"]
     big_pickups_map = level_data["big_pickups_map"]
 
+    bake_dimensions(level_data, range(len(level_data["dimensions_svgs"])))
+
     for i in range(len(level_data["dimensions_svgs"])):
-        svg = level_data["dimensions_svgs"][i][:]
-        bounds = get_bounds_svg_multi(level_data["meshes"][i])
+        svg = SvgDocument(level_data["dimensions_svgs"][i])
+        bounds = level_data["dimensions_bounds"][i]
 
         if show_containers:
-            for _, containers_in_zone in container_map.get(i, {}).items():
-                for id, container in containers_in_zone.items():
-                    pos = container["position"]
-                    name = container["image"].split("_")[0]
+            for _zone, id, container in dimension_spawns(container_map, i):
+                pos = container["position"]
+                name = container["image"].split("_")[0]
     
-                    if not hide_images:
-                        svg = add_item(svg, name, pos, 0, bounds)
-                        pos = (pos[0], pos[1] + 1)
-                    
-                    pos = (pos[0], pos[1] + 9)
-                    svg = add_text(svg, pos, bounds, str(id), text_size)
+                if not hide_images:
+                    svg = add_item(svg, name, pos, 0, bounds)
+                    pos = (pos[0], pos[1] + 1)
+                
+                pos = (pos[0], pos[1] + 9)
+                svg = add_text(svg, pos, bounds, str(id), text_size)
 
         if show_small_pickups:
-            for _, small_pickups_in_zone in small_pickups_map.get(i, {}).items():
-                for id, pickup in small_pickups_in_zone.items():
-                    pos = pickup["position"]
-                    name = "small_pickup"
+            for _zone, id, pickup in dimension_spawns(small_pickups_map, i):
+                pos = pickup["position"]
+                name = "small_pickup"
     
-                    if not hide_images:
-                        svg = add_item(svg, name, pos, 0, bounds)
-                        pos = (pos[0], pos[1] + 1)
-                        
-                    pos = (pos[0], pos[1] + 9)
-                    svg = add_text(svg, pos, bounds, str(id), text_size)
+                if not hide_images:
+                    svg = add_item(svg, name, pos, 0, bounds)
+                    pos = (pos[0], pos[1] + 1)
+                    
+                pos = (pos[0], pos[1] + 9)
+                svg = add_text(svg, pos, bounds, str(id), text_size)
 
         if show_big_pickups:
-            for _, big_pickups_in_zone in big_pickups_map.get(i, {}).items():
-                for id, pickup in big_pickups_in_zone.items():
-                    pos = pickup["position"]
-                    name = "big_pickup"
+            for _zone, id, pickup in dimension_spawns(big_pickups_map, i):
+                pos = pickup["position"]
+                name = "big_pickup"
     
-                    if not hide_images:
-                        svg = add_item(svg, name, pos, 0, bounds)
-                        pos = (pos[0], pos[1] + 1)
-                        
-                    pos = (pos[0], pos[1] + 9)
-                    svg = add_text(svg, pos, bounds, str(id), text_size)
+                if not hide_images:
+                    svg = add_item(svg, name, pos, 0, bounds)
+                    pos = (pos[0], pos[1] + 1)
+                    
+                pos = (pos[0], pos[1] + 9)
+                svg = add_text(svg, pos, bounds, str(id), text_size)
 
         open_generated_svg(svg, i)
 
+    metrics.log.info("render: %s", metrics.summary_line())
+
 
 if __name__ == "__main__":
     main()
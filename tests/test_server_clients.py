@@ -0,0 +1,162 @@
+import asyncio
+import statistics
+import time
+
+import pytest
+
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient
+
+from html_server import server
+from html_server.tiles import TileIndex
+
+POSTS = 30
+
+
+class RecordingSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, payload):
+        self.sent.append(payload)
+
+    async def close(self):
+        pass
+
+
+class StalledSocket(RecordingSocket):
+    # a viewer whose connection stopped reading, every send hangs
+    async def send_text(self, payload):
+        await asyncio.Event().wait()
+
+
+class BrokenSocket(RecordingSocket):
+    async def send_text(self, payload):
+        raise ConnectionResetError("viewer went away")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, "MAPS", {})
+    monkeypatch.setattr(server, "pending_lods", {})
+    monkeypatch.setattr(server, "TILE_INDEXES", {})
+    monkeypatch.setattr(server, "pending_deltas", {})
+    monkeypatch.setattr(server, "clients", set())
+    # overlays go out right away, the tests wait for them
+    monkeypatch.setattr(server, "OVERLAY_BROADCAST_DELAY", 0)
+
+    with TestClient(server.app) as test_client:
+        yield test_client
+
+
+def add_viewer(test_client, socket):
+    async def register():
+        viewer = server.Client(socket)
+        server.clients.add(viewer)
+        return viewer
+
+    return test_client.portal.call(register)
+
+
+def settle(test_client, seconds=0.05):
+    # lets the send loops and delayed overlay broadcasts run
+    test_client.portal.call(asyncio.sleep, seconds)
+
+
+def post_latencies(test_client):
+    """
+    Median seconds of a full map POST and of an overlay POST.
+    """
+    full = []
+    for _ in range(POSTS):
+        start = time.perf_counter()
+        assert test_client.post("/svg/0", content=b"<svg><path d='M0 0L1 1Z'/></svg>").status_code == 200
+        full.append(time.perf_counter() - start)
+
+    # more deltas than a viewer may fall behind by, a full map would clear them
+    overlay = []
+    for i in range(server.CLIENT_QUEUE_SIZE + POSTS):
+        start = time.perf_counter()
+        assert test_client.post("/svg/0/overlay", content=f"<g id='{i}'/>".encode()).json() == {"ok": True}
+        overlay.append(time.perf_counter() - start)
+        settle(test_client, 0)
+
+    return statistics.median(full), statistics.median(overlay)
+
+
+def test_stalled_viewer_keeps_post_latency_flat(client):
+    healthy = RecordingSocket()
+    add_viewer(client, healthy)
+    full_before, overlay_before = post_latencies(client)
+
+    stalled = add_viewer(client, StalledSocket())
+    full_after, overlay_after = post_latencies(client)
+    settle(client)
+
+    # the stalled viewer costs nothing per POST, only noise is allowed
+    assert full_after < full_before * 3 + 0.005
+    assert overlay_after < overlay_before * 3 + 0.005
+
+    # its queue was collapsed instead of growing with every POST
+    assert len(stalled.pending) <= server.CLIENT_QUEUE_SIZE
+    # and the other viewer got every version
+    assert healthy.sent
+    assert str(server.current_version("0")) in healthy.sent[-1]
+
+
+def test_stalled_viewer_is_dropped_after_send_timeout(client, monkeypatch):
+    monkeypatch.setattr(server, "SEND_TIMEOUT", 0.05)
+    healthy = RecordingSocket()
+    add_viewer(client, healthy)
+    stalled = add_viewer(client, StalledSocket())
+
+    client.post("/svg/0", content=b"<svg></svg>")
+    settle(client, 0.2)
+
+    assert stalled not in server.clients
+    client.post("/svg/0/overlay", content=b"<g/>")
+    settle(client)
+    assert len(healthy.sent) == 2
+
+
+def test_broken_viewer_is_dropped(client):
+    healthy = RecordingSocket()
+    add_viewer(client, healthy)
+    broken = add_viewer(client, BrokenSocket())
+
+    client.post("/svg/0", content=b"<svg></svg>")
+    settle(client)
+    assert broken not in server.clients
+
+    client.post("/svg/0", content=b"<svg></svg>")
+    settle(client)
+    assert len(healthy.sent) == 2
+
+
+def test_overlays_are_joined_when_fetched(client):
+    client.post("/svg/0", content=b"<svg><path d='M0 0L1 1Z'/></svg>")
+    for i in range(3):
+        client.post("/svg/0/overlay", content=f"<g id='{i}'/>".encode())
+
+    # nothing is joined until a viewer asks for the map
+    record = server.MAPS["0"]
+    assert record.svg.joined is None
+
+    expected = "<svg><path d='M0 0L1 1Z'/><g id='0'/><g id='1'/><g id='2'/></svg>"
+    assert client.get("/current_svg/0").text == expected
+    assert client.get("/current_svg/0", headers={"Accept-Encoding": "identity"}).text == expected
+
+
+def test_overlay_versions_extend_the_tile_index(client):
+    client.post("/svg/0", content=b"<svg viewBox='0 0 100 100'><path d='M0 0L100 0L100 100Z'/></svg>")
+    _, first = server.get_tile_index("0")
+
+    client.post("/svg/0/overlay", content=b"<g transform='translate(10, 20)'><circle r='1'/></g>")
+    client.post("/svg/0/overlay", content=b"<g transform='translate(80, 90)'><circle r='1'/></g>")
+    _, extended = server.get_tile_index("0")
+
+    # the floor is shared, the tiles read like the ones of a new index
+    assert extended.floor_tree is first.floor_tree
+    fresh = TileIndex(server.MAPS["0"].svg.data)
+    for z, x, y in [(0, 0, 0), (1, 0, 0), (1, 1, 1), (2, 3, 3)]:
+        assert extended.tile(z, x, y) == fresh.tile(z, x, y)